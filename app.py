@@ -1,85 +1,149 @@
-from flask import Flask, render_template, request, jsonify, session, redirect
+from flask import Flask, render_template, request, jsonify, session, redirect, Response, stream_with_context
+import atexit
 import sqlite3
 import json
-import re
-from datetime import datetime
+import os
+import sys
+from datetime import datetime, timezone
 import threading
 import time
 import hashlib
+import functools
+import db
+import metrics
+import migrations
+from db import get_db
+from dashboard import dashboard_version, dashboard_data, dashboard_events
+from events import EventBroker, EventRelay, OrderWaiters, format_sse
+from ingest import TransactionWriter, record_transactions
+from matcher import PaymentMatcher
+from menu import MenuCache, menu_version, parse_menu_item
+from page_cache import CachedPage
+from reconciler import ReconciliationWorker
+from references import ReferenceAllocator
+from retention import expire_pending_orders, archive_old_rows
+from stats import sales_summary
+from orders import ORDER_ITEM_FIELDS, parse_order_form, save_order_items, item_label
+
+# The SMS parser ships inside the forwarder app (app/), which is packaged on
+# its own, so the server imports it from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+from mpesa_parser import parse_mpesa_sms
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
-
-# Sample menu data
-MENU_ITEMS = [
-    {"id": 1, "name": "rice", "price": 1500, "category": "Main"},
-    {"id": 2, "name": "ndengu", "price":1000, "category": "Main"},
-    {"id": 3, "name": "ugali", "price": 40, "category": "Sides"},
-    {"id": 4, "name": "fulu", "price": 30, "category": "Main"},
-    {"id": 5, "name": "omena", "price": 30, "category": "Main"},
-    {"id": 6, "name": "tea", "price": 20, "category": "Drinks"},
-]
+app.config['DATABASE'] = 'orders.db'
+# Background payment matching; set RECONCILE_MAX_INTERVAL to 0 to disable
+app.config['RECONCILE_BATCH_SIZE'] = 500
+app.config['RECONCILE_MIN_INTERVAL'] = 1
+app.config['RECONCILE_MAX_INTERVAL'] = 30
+# Pending orders expire after PENDING_ORDER_TTL seconds; finished orders and
+# transactions move to monthly files in ARCHIVE_DIR after ARCHIVE_AFTER_DAYS.
+# Set MAINTENANCE_MAX_INTERVAL to 0 to disable
+app.config['PENDING_ORDER_TTL'] = 6 * 60 * 60
+app.config['ARCHIVE_AFTER_DAYS'] = 90
+app.config['ARCHIVE_DIR'] = 'archive'
+app.config['MAINTENANCE_BATCH_SIZE'] = 500
+app.config['MAINTENANCE_MIN_INTERVAL'] = 60
+app.config['MAINTENANCE_MAX_INTERVAL'] = 600
+# Incoming transactions are written in groups: the writer waits up to this
+# many seconds for more requests before committing
+app.config['GROUP_COMMIT_DELAY'] = 0.002
+# Order pages waiting on /api/orders/<id>/status each hold a server thread;
+# beyond this many per process the status is answered straight away with a
+# hint to ask again. Keep it well below gunicorn's threads per worker
+app.config['ORDER_STATUS_MAX_WAITERS'] = 16
+# Directory where each worker process leaves its metrics for /metrics to
+# add up; only needed when serving with several processes
+app.config['METRICS_DIR'] = None
+# Any setting can be overridden from FLASK_<NAME> environment variables,
+# e.g. FLASK_DATABASE=/srv/orders/orders.db or FLASK_SECRET_KEY=...
+app.config.from_prefixed_env()
+db.init_app(app)
+metrics.init_app(app)
 
 # Your M-Pesa PayBill details
 PAYBILL_NUMBER = "8834998"
 BUSINESS_NAME = "RESTAURANT"
 
-# Initialize database
 def init_db():
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS orders
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  customer_name TEXT,
-                  items TEXT,
-                  total_amount INTEGER,
-                  status TEXT DEFAULT 'pending',
-                  reference TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  sender_name TEXT,
-                  amount INTEGER,
-                  reference TEXT,
-                  order_id INTEGER,
-                  sms_text TEXT,
-                  received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    """Bring the schema up to date; safe to run in several processes at once"""
+    with app.app_context():
+        migrations.migrate(get_db())
+    # A preloading server forks its workers after this, and SQLite
+    # connections must not be shared across a fork
+    app.extensions['db_pool'].close_all()
 
-init_db()
+# Per-process state.  Each of these is safe with several worker processes:
+# the matcher claims orders with conditional updates, the menu cache and
+# reference allocator check or reserve through the database, and events
+# reach every process's subscribers and order status waiters through its
+# EventRelay.
+payment_matcher = PaymentMatcher()
+event_broker = EventBroker()
+order_waiters = OrderWaiters()
+event_relay = None
+transaction_writer = None
+menu_cache = MenuCache()
+reference_allocator = ReferenceAllocator()
+admin_page = None
+metrics.MATCHER_BACKLOG.set_function(lambda: payment_matcher.backlog(get_db()))
 
 # Customer Routes
 @app.route('/')
 def menu():
-    return render_template('menu.html', menu_items=MENU_ITEMS)
+    # The menu page only changes with the menu, so it is rendered and
+    # compressed once per menu version and then served from memory
+    current_menu = menu_cache.current(get_db())
+    if current_menu.page is None:
+        current_menu.page = CachedPage(render_template('menu.html', menu_items=current_menu.items))
+    return current_menu.page.make_response()
+
+@app.route('/api/menu')
+def get_menu():
+    """Orderable menu items; the ETag is the menu version"""
+    current_menu = menu_cache.current(get_db())
+    response = jsonify({'version': current_menu.version, 'items': current_menu.items})
+    response.set_etag(f"menu-{current_menu.version}")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# References tried per order before giving up
+REFERENCE_ATTEMPTS = 5
 
 @app.route('/order', methods=['POST'])
 def create_order():
     customer_name = request.form.get('customer_name')
-    selected_items = request.form.getlist('items')
+    current_menu = menu_cache.current(get_db())
     
     # Calculate total and create order summary
-    order_details = []
-    total = 0
-    for item_id in selected_items:
-        item = next((x for x in MENU_ITEMS if x['id'] == int(item_id)), None)
-        if item:
-            order_details.append(item['name'])
-            total += item['price']
+    order_lines, total = parse_order_form(request.form, current_menu)
+    order_details = [item_label(line) for line in order_lines]
     
-    # Generate unique reference
-    reference = f"ORD{datetime.now().strftime('%H%M%S')}"
-    
-    # Save to database
-    conn = sqlite3.connect('orders.db')
+    # Save to database. Allocated references never repeat; the retry only
+    # skips one that happens to equal an old time-based reference.
+    conn = get_db()
     c = conn.cursor()
-    c.execute('''INSERT INTO orders (customer_name, items, total_amount, reference)
-                 VALUES (?, ?, ?, ?)''',
-              (customer_name, json.dumps(order_details), total, reference))
+    for attempt in range(REFERENCE_ATTEMPTS):
+        reference = reference_allocator.allocate(conn)
+        try:
+            with metrics.timed_query('orders.insert') as query:
+                c.execute('''INSERT INTO orders (customer_name, total_amount, reference)
+                             VALUES (?, ?, ?)''',
+                          (customer_name, total, reference))
+                query.rows = 1
+            break
+        except sqlite3.IntegrityError:
+            # End the failed insert's transaction: allocate() may need
+            # BEGIN IMMEDIATE to reserve a new block
+            conn.rollback()
+            if attempt == REFERENCE_ATTEMPTS - 1:
+                raise
     order_id = c.lastrowid
+    save_order_items(c, order_id, order_lines)
     conn.commit()
-    conn.close()
+    
+    notify_changes()
     
     # Generate M-Pesa USSD code
     ussd_code = f"*144*{PAYBILL_NUMBER}*{total}*{reference}#"
@@ -274,101 +338,391 @@ def admin_dashboard():
     '''
 
 def render_admin_dashboard():
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    
-    # Get pending orders
-    c.execute('''SELECT * FROM orders WHERE status = 'pending' ORDER BY created_at DESC''')
-    pending_orders = c.fetchall()
-    
-    # Get completed orders
-    c.execute('''SELECT * FROM orders WHERE status = 'paid' ORDER BY created_at DESC''')
-    completed_orders = c.fetchall()
-    
-    # Get recent transactions
-    c.execute('''SELECT * FROM transactions ORDER BY received_at DESC LIMIT 10''')
-    transactions = c.fetchall()
-    
-    conn.close()
-    
-    return render_template('admin.html',
-                         pending_orders=pending_orders,
-                         completed_orders=completed_orders,
-                         transactions=transactions)
+    # The page is a shell that loads its data from /api/dashboard, so it is
+    # rendered once per process
+    global admin_page
+    if admin_page is None:
+        admin_page = CachedPage(render_template('admin.html'))
+    return admin_page.make_response()
 
 @app.route('/admin/logout')
 def admin_logout():
     session.pop('admin_logged_in', None)
     return redirect('/') 
 
-@app.route('/api/orders')
-def get_orders():
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
-    c.execute('''SELECT * FROM orders ORDER BY created_at DESC''')
-    orders = c.fetchall()
-    conn.close()
-    
-    # Convert to dict
-    orders_list = []
-    for order in orders:
-        orders_list.append({
-            'id': order[0],
-            'customer_name': order[1],
-            'items': json.loads(order[2]),
-            'total_amount': order[3],
-            'status': order[4],
-            'reference': order[5],
-            'created_at': order[6]
-        })
+def admin_required(view):
+    """Reject API calls from browsers that have not logged in to the dashboard"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not session.get('admin_logged_in'):
+            return jsonify({'status': 'failed', 'error': 'Admin login required'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+DASHBOARD_PAGE_SIZE = 50
+DASHBOARD_MAX_PAGE_SIZE = 200
+
+@app.route('/api/dashboard')
+@admin_required
+def dashboard():
+    """Dashboard orders, transactions and sales figures.
+
+    With ?since=<version> only what changed after that version is returned;
+    the ETag is the current version, so an unchanged dashboard is a 304.
+    """
+    try:
+        since = request.args.get('since', type=int)
+        limit = int(request.args.get('limit', DASHBOARD_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'status': 'failed', 'error': 'limit must be an integer'}), 400
+    limit = min(max(limit, 1), DASHBOARD_MAX_PAGE_SIZE)
     
-    return jsonify(orders_list)
+    conn = get_db()
+    version = dashboard_version(conn)
+    # Today's figures change at midnight without any new rows
+    etag = f"dashboard-{version}-{datetime.now(timezone.utc).strftime('%Y-%m-%d')}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(dashboard_data(conn, since, limit, version))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
-@app.route('/api/check_payments')
-def check_payments():
-    # This would be called periodically to check for new payments
-    conn = sqlite3.connect('orders.db')
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request latency, named query and matcher metrics for Prometheus to scrape"""
+    return Response(metrics.render(app.config['METRICS_DIR']), content_type=metrics.CONTENT_TYPE)
+
+STATS_MAX_DAYS = 366
+
+@app.route('/api/stats')
+@admin_required
+def stats():
+    """Sales totals, hourly and daily figures and top items from the rollup tables"""
+    try:
+        days = int(request.args.get('days', 7))
+        top_items = int(request.args.get('top', 10))
+    except ValueError:
+        return jsonify({'status': 'failed', 'error': 'days and top must be integers'}), 400
+    if not 1 <= days <= STATS_MAX_DAYS:
+        return jsonify({'status': 'failed', 'error': f'days must be between 1 and {STATS_MAX_DAYS}'}), 400
+    if top_items < 1:
+        return jsonify({'status': 'failed', 'error': 'top must be at least 1'}), 400
+    return jsonify(sales_summary(get_db(), days, top_items))
+
+@app.route('/api/admin/menu', methods=['GET', 'POST'])
+@admin_required
+def admin_menu():
+    """List every menu item (including unavailable ones) or add a new one"""
+    conn = get_db()
+    if request.method == 'GET':
+        current_menu = menu_cache.current(conn)
+        return jsonify({'version': current_menu.version, 'items': current_menu.all_items})
+
+    fields, error = parse_menu_item(request.get_json(silent=True))
+    if error:
+        return jsonify({'status': 'failed', 'error': error}), 400
     c = conn.cursor()
+    c.execute('''INSERT INTO menu_items (name, price, category, available)
+                 VALUES (?, ?, ?, ?)''',
+              (fields['name'], fields['price'], fields['category'], fields.get('available', 1)))
+    item_id = c.lastrowid
+    conn.commit()
+    return jsonify({'status': 'success', 'id': item_id, 'version': menu_version(conn)}), 201
+
+@app.route('/api/admin/menu/<int:item_id>', methods=['PUT', 'PATCH', 'DELETE'])
+@admin_required
+def admin_menu_item(item_id):
+    """Update (PUT replaces, PATCH changes some fields) or delete a menu item"""
+    conn = get_db()
+    c = conn.cursor()
+    if request.method == 'DELETE':
+        c.execute('DELETE FROM menu_items WHERE id = ?', (item_id,))
+    else:
+        fields, error = parse_menu_item(request.get_json(silent=True), partial=request.method == 'PATCH')
+        if error:
+            return jsonify({'status': 'failed', 'error': error}), 400
+        assignments = ', '.join(f"{column} = ?" for column in fields)
+        c.execute(f'''UPDATE menu_items SET {assignments}, updated_at = CURRENT_TIMESTAMP
+                      WHERE id = ?''', list(fields.values()) + [item_id])
+
+    if c.rowcount == 0:
+        conn.rollback()
+        return jsonify({'status': 'failed', 'error': 'Menu item not found'}), 404
+    conn.commit()
+    return jsonify({'status': 'success', 'version': menu_version(conn)})
+
+# Columns clients may ask for with ?fields=
+ORDER_FIELDS = ('id', 'customer_name', 'items', 'total_amount', 'status', 'reference', 'created_at')
+ORDERS_PAGE_SIZE = 100
+ORDERS_MAX_PAGE_SIZE = 1000
+
+def parse_timestamp_arg(name):
+    """Read an ISO date/datetime query argument in the format SQLite stores"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+
+def iter_orders(c, fields, columns):
+    """Yield order dicts from rows of columns, each optionally followed by an order_items row.
+
+    With items, an order spans one row per line (or a single row of NULLs
+    from the LEFT JOIN), so consecutive rows are folded into one dict.
+    """
+    with_items = 'items' in fields
+    id_index = columns.index('id')
+    order = None
+    order_id = None
+    while True:
+        rows = c.fetchmany(500)
+        if not rows:
+            break
+        for row in rows:
+            if order is None or row[id_index] != order_id:
+                if order is not None:
+                    yield order_id, order
+                order_id = row[id_index]
+                values = dict(zip(columns, row))
+                order = {field: [] if field == 'items' else values[field] for field in fields}
+            if with_items and row[len(columns) + 1] is not None:
+                order['items'].append(dict(zip(ORDER_ITEM_FIELDS, row[len(columns):])))
+    if order is not None:
+        yield order_id, order
+
+@app.route('/api/orders')
+def get_orders():
+    """List orders newest first.
+
+    Query arguments: after_id (keyset cursor), limit, status, since, until,
+    fields (comma separated) and format=ndjson to stream every matching row.
+    """
+    try:
+        fields = request.args.get('fields')
+        fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(ORDER_FIELDS)
+        unknown = [f for f in fields if f not in ORDER_FIELDS]
+        if unknown:
+            raise ValueError(f"unknown field(s): {', '.join(unknown)}")
+        after_id = request.args.get('after_id', type=int)
+        limit = request.args.get('limit', ORDERS_PAGE_SIZE, type=int)
+        since = parse_timestamp_arg('since')
+        until = parse_timestamp_arg('until')
+    except ValueError as e:
+        return jsonify({'status': 'failed', 'error': str(e)}), 400
     
-    # Get all pending orders
-    c.execute('''SELECT * FROM orders WHERE status = 'pending' ''')
-    pending_orders = c.fetchall()
+    stream = request.args.get('format') == 'ndjson'
+    # items come from order_items; the cursor needs the id even when the
+    # client did not ask for it
+    columns = [f for f in fields if f != 'items']
+    if 'id' not in columns:
+        columns.append('id')
     
-    # Get all transactions
-    c.execute('''SELECT * FROM transactions''')
-    transactions = c.fetchall()
+    where = []
+    params = []
+    if after_id is not None:
+        where.append('id < ?')
+        params.append(after_id)
+    if request.args.get('status'):
+        where.append('status = ?')
+        params.append(request.args['status'])
+    if since:
+        where.append('created_at >= ?')
+        params.append(since)
+    if until:
+        where.append('created_at < ?')
+        params.append(until)
+    query = f"SELECT {', '.join(columns)} FROM orders"
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    # ids grow with created_at, so ordering by id gives the same order and
+    # lets after_id act as a keyset cursor
+    query += ' ORDER BY id DESC'
     
-    # Match transactions to orders
-    matched_count = 0
-    matched_orders = []
+    if stream:
+        # Exports are not paged
+        if 'limit' in request.args:
+            query += ' LIMIT ?'
+            params.append(max(limit, 0))
+    else:
+        limit = min(max(limit, 1), ORDERS_MAX_PAGE_SIZE)
+        query += ' LIMIT ?'
+        params.append(limit)
+    if 'items' in fields:
+        # One query for the page and its lines; the limit applies to orders
+        query = f"""WITH page AS ({query})
+                    SELECT page.*, {', '.join('oi.' + f for f in ORDER_ITEM_FIELDS)} FROM page
+                    LEFT JOIN order_items oi ON oi.order_id = page.id
+                    ORDER BY page.id DESC, oi.id"""
+    
+    c = get_db().cursor()
     
-    for transaction in transactions:
-        transaction_name = transaction[1]  # name from transaction
-        transaction_amount = transaction[2]  # amount from transaction
+    if stream:
+        with metrics.timed_query('orders.export'):
+            c.execute(query, params)
+        
+        # Rows are encoded as they are read
+        def generate():
+            for order_id, order in iter_orders(c, fields, columns):
+                yield json.dumps(order) + '\n'
         
-        # Find matching order
-        for order in pending_orders:
-            order_customer_name = order[1]  # customer name from order
-            order_amount = order[3]  # amount from order
-            
-            # Check if both name AND amount match
-            if order_customer_name.lower().strip() == transaction_name.lower().strip() and order_amount == transaction_amount:
-                # Update order status to 'completed'
-                c.execute('''UPDATE orders SET status = 'completed' WHERE id = ?''', (order[0],))
-                conn.commit()
-                
-                # Add to matched orders list for response
-                matched_orders.append({
-                    'order_id': order[0],
-                    'customer_name': order_customer_name,
-                    'amount': order_amount,
-                    'items': order[2]
-                })
-                
-                matched_count += 1
-                break  # Move to next transaction after finding a match
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
     
-    conn.close()
+    with metrics.timed_query('orders.list') as timer:
+        c.execute(query, params)
+        orders = list(iter_orders(c, fields, columns))
+        timer.rows = len(orders)
+    response = jsonify([order for order_id, order in orders])
+    if len(orders) == limit:
+        # More rows may follow; pass this back as ?after_id= for the next page
+        response.headers['X-Next-After-Id'] = str(orders[-1][0])
+    return response
+
+# Longest a status request is held open, in seconds; phones and proxies
+# drop idle connections not long after half a minute
+ORDER_STATUS_TIMEOUT = 25
+# Seconds a client is asked to wait before polling again when every
+# waiting slot is taken
+ORDER_STATUS_RETRY_AFTER = 5
+
+def read_order_status(order_id, reference):
+    # The request may be parked for a while, so it borrows a connection
+    # for each read instead of holding one from the pool
+    with app.extensions['db_pool'].connection() as conn, metrics.timed_query('orders.status'):
+        row = conn.execute('SELECT status FROM orders WHERE id = ? AND reference = ?',
+                           (order_id, reference)).fetchone()
+    return row[0] if row else None
+
+@app.route('/api/orders/<int:order_id>/status')
+def order_status(order_id):
+    """Long-poll for an order's status.
+
+    Answers as soon as the status differs from ?status= (the one the
+    client last saw), or with the unchanged status after ?timeout= seconds.
+    ?reference= must be the order's reference.  When ORDER_STATUS_MAX_WAITERS
+    requests are already waiting, answers at once with ``retry_after``, the
+    seconds to wait before asking again.
+    """
+    reference = request.args.get('reference', '')
+    known_status = request.args.get('status')
+    timeout = request.args.get('timeout', ORDER_STATUS_TIMEOUT, type=float)
+    deadline = time.monotonic() + max(0, min(timeout, ORDER_STATUS_TIMEOUT))
+    
+    # Registered before the first read, so a payment landing in between
+    # still wakes this request
+    with order_waiters.waiting(order_id, app.config['ORDER_STATUS_MAX_WAITERS']) as changed:
+        while True:
+            status = read_order_status(order_id, reference)
+            remaining = deadline - time.monotonic()
+            if changed is None or status is None or status != known_status or remaining <= 0:
+                break
+            changed.wait(remaining)
+            changed.clear()
+    
+    if status is None:
+        return jsonify({'status': 'failed', 'error': 'Order not found'}), 404
+    data = {'status': 'success', 'order_id': order_id, 'order_status': status}
+    if changed is None and status == known_status:
+        # No thread to spare; the client polls again later instead
+        data['retry_after'] = ORDER_STATUS_RETRY_AFTER
+    response = jsonify(data)
+    if 'retry_after' in data:
+        response.headers['Retry-After'] = str(ORDER_STATUS_RETRY_AFTER)
+    response.cache_control.no_store = True
+    return response
+
+def match_new_payments(limit=None):
+    """Run the matcher over new transactions and announce the orders it paid"""
+    matched_orders = payment_matcher.poll(get_db(), limit)
+    if matched_orders:
+        notify_changes()
+    return matched_orders
+
+def reconcile_payments():
+    """One pass of the background worker; returns how many transactions it examined"""
+    batch_size = app.config['RECONCILE_BATCH_SIZE']
+    examined = min(payment_matcher.backlog(get_db()), batch_size)
+    if examined:
+        match_new_payments(batch_size)
+    return examined
+
+def run_maintenance():
+    """One pass of the maintenance worker; returns how many orders it expired"""
+    conn = get_db()
+    batch_size = app.config['MAINTENANCE_BATCH_SIZE']
+    expired = expire_pending_orders(conn, app.config['PENDING_ORDER_TTL'], batch_size)
+    if expired:
+        notify_changes()
+    if len(expired) < batch_size:
+        archive_old_rows(conn, app.config['ARCHIVE_DIR'], app.config['ARCHIVE_AFTER_DAYS'])
+    return len(expired)
+
+def notify_changes():
+    """Have this process's event relay publish a change just committed and wake status requests"""
+    if event_relay is not None:
+        event_relay.notify()
+
+EVENT_RELAY_LIMIT = 500
+
+def dashboard_changes(since):
+    """Change version and dashboard events after since, for the EventRelay"""
+    conn = get_db()
+    version = dashboard_version(conn)
+    if since is None or since == version:
+        return version, []
+    data = dashboard_data(conn, since, EVENT_RELAY_LIMIT, version,
+                          transactions=EVENT_RELAY_LIMIT, stats=False)
+    return version, dashboard_events(data)
+
+background_workers = None
+background_workers_pid = None
+background_workers_lock = threading.Lock()
+
+def start_background_workers():
+    """Start this process's background threads, once per process.
+
+    Every process runs an event relay and a transaction writer (and a metrics
+    writer when METRICS_DIR is set); the payment matcher and maintenance
+    workers that are enabled start everywhere too, but leases let only one
+    process run each.
+    """
+    global background_workers, background_workers_pid
+    with background_workers_lock:
+        # A forked worker inherits the globals but not the parent's threads
+        if background_workers_pid == os.getpid():
+            return background_workers
+        background_workers_pid = os.getpid()
+        background_workers = _start_background_workers()
+        return background_workers
+
+def _start_background_workers():
+    global event_relay, transaction_writer
+    event_relay = EventRelay(app, event_broker, dashboard_changes, waiters=order_waiters)
+    transaction_writer = TransactionWriter(app, delay=app.config['GROUP_COMMIT_DELAY'])
+    workers = [event_relay, transaction_writer]
+    if app.config['METRICS_DIR']:
+        workers.append(metrics.SnapshotWriter(app.config['METRICS_DIR']))
+    if app.config['RECONCILE_MAX_INTERVAL']:
+        workers.append(ReconciliationWorker(app, reconcile_payments, name='reconciler',
+                                            batch_size=app.config['RECONCILE_BATCH_SIZE'],
+                                            min_interval=app.config['RECONCILE_MIN_INTERVAL'],
+                                            max_interval=app.config['RECONCILE_MAX_INTERVAL']))
+    if app.config['MAINTENANCE_MAX_INTERVAL']:
+        workers.append(ReconciliationWorker(app, run_maintenance, name='maintenance',
+                                            batch_size=app.config['MAINTENANCE_BATCH_SIZE'],
+                                            min_interval=app.config['MAINTENANCE_MIN_INTERVAL'],
+                                            max_interval=app.config['MAINTENANCE_MAX_INTERVAL']))
+    for worker in workers:
+        worker.start()
+        atexit.register(worker.stop, 5)
+    return workers
+
+@app.route('/api/check_payments')
+def check_payments():
+    # This would be called periodically to check for new payments.
+    # Only transactions received since the previous check are examined.
+    matched_orders = match_new_payments()
+    matched_count = len(matched_orders)
     
     if matched_count > 0:
         return jsonify({
@@ -378,26 +732,6 @@ def check_payments():
         })
     else:
         return jsonify({'status': 'checked', 'message': 'No matching payments found'})
-def parse_mpesa_sms(sms_text):
-    """Parse M-Pesa SMS to extract name, amount, reference"""
-    patterns = [
-        # Pattern: Ksh1,000 from JOHN DOE on 12/12/24 RefABC123
-        r"Ksh([\d,]+)\.?\s*from\s*(.*?)\s*on\s*\d+/\d+/\d+.*?Ref(\w+)",
-        # Pattern: Confirmed. Ksh500.00 paid to BUSINESS. RefXYZ789
-        r"Confirmed\.\s*Ksh([\d,]+)\.\d+\s*paid to.*?Ref(\w+)",
-        # Custom pattern for your business
-        r"Ksh([\d,]+).*?from\s*(.*?)\s*.*?Ref(\w+)"
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, sms_text, re.IGNORECASE)
-        if match:
-            return {
-                'amount': int(match.group(1).replace(',', '')),
-                'sender_name': match.group(2).strip().title(),
-                'reference': match.group(3).strip()
-            }
-    return None
 
 # Simulate receiving SMS (Replace this with actual SMS reading)
 def simulate_sms_receiver():
@@ -405,56 +739,180 @@ def simulate_sms_receiver():
     # In real implementation, this would read from GSM modem or Android app
     pass
 
+# Largest batch accepted by /api/add_transactions
+MAX_TRANSACTION_BATCH = 1000
+
+def store_transactions(entries):
+    """Record (sms_text, transaction, message_id) entries, grouped with other
+    requests' by the transaction writer"""
+    if transaction_writer is None:
+        return record_transactions(get_db(), entries)
+    return transaction_writer.submit(entries)
+
+def storage_unavailable(error):
+    """Reply for entries that could not be stored in time.
+
+    The entries may still turn up, so this is not a plain failure: the
+    forwarder resends them with the same message_id, which is stored once
+    whichever attempt lands.
+    """
+    app.logger.warning('Could not store transactions: %s', error)
+    response = jsonify({'status': 'retry', 'error': 'Server busy, send again with the same message_id'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def announce_transactions(entries, results):
+    """Announce stored transactions and run the matcher for unmatched ones"""
+    notify_changes()
+    unmatched = False
+    for (sms_text, transaction, message_id), result in zip(entries, results):
+        order = result['order']
+        if order:
+            app.logger.info('Order %s paid by %s', order[0], transaction.sender_name)
+        elif result['duplicate']:
+            app.logger.info('Ignored resent message %s', message_id)
+        else:
+            unmatched = True
+    
+    if unmatched:
+        # Try the name/amount match straight away rather than waiting
+        # for the next check_payments call
+        match_new_payments()
+
 @app.route('/api/add_transaction', methods=['POST'])
 def add_transaction():
     """Endpoint to add transaction from SMS reader"""
     data = request.json
-    sms_text = data.get('sms_text')
+    if not isinstance(data, dict) or not isinstance(data.get('sms_text'), str):
+        return jsonify({'status': 'failed', 'error': 'sms_text must be a string'}), 400
+    sms_text = data['sms_text']
+    # Optional; a forwarder that resends after a lost response sends the
+    # same id so the message is only stored once
+    message_id = data.get('message_id')
+    if message_id is not None and not isinstance(message_id, str):
+        return jsonify({'status': 'failed', 'error': 'message_id must be a string'}), 400
     
     # Parse the SMS
-    transaction_data = parse_mpesa_sms(sms_text)
+    transaction = parse_mpesa_sms(sms_text)
     
-    if transaction_data:
-        conn = sqlite3.connect('orders.db')
-        c = conn.cursor()
-        
-        # Save transaction
-        c.execute('''INSERT INTO transactions (sender_name, amount, reference, sms_text)
-                     VALUES (?, ?, ?, ?)''',
-                  (transaction_data['sender_name'], transaction_data['amount'], 
-                   transaction_data['reference'], sms_text))
+    if transaction:
+        entries = [(sms_text, transaction, message_id)]
+        try:
+            results = store_transactions(entries)
+        except sqlite3.OperationalError as e:
+            return storage_unavailable(e)
+        announce_transactions(entries, results)
         
-        # Check if it matches any pending order
-        c.execute('''SELECT * FROM orders WHERE reference = ? AND total_amount = ? AND status = 'pending'\n''',
-                  (transaction_data['reference'], transaction_data['amount']))
-        matching_order = c.fetchone()
-        
-        if matching_order:
-            # Mark order as paid
-            c.execute('''UPDATE orders SET status = 'paid' WHERE id = ?''', (matching_order[0],))
-            print(f"✅ Order {matching_order[0]} paid by {transaction_data['sender_name']}")
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'status': 'success', 'matched_order': bool(matching_order)})
+        return jsonify({'status': 'success', 'matched_order': results[0]['order'] is not None,
+                        'duplicate': results[0]['duplicate']})
     
     return jsonify({'status': 'failed', 'error': 'Could not parse SMS'})
 
-if __name__ == '__main__':
-    # Start background thread for payment checking
-    def background_checker():
-        while True:
-            time.sleep(7)  # Check every 10 seconds
-            try:
-                with app.app_context():
-                    check_payments()
-            except:
-                pass
+@app.route('/api/add_transactions', methods=['POST'])
+def add_transactions():
+    """Bulk endpoint for the SMS reader.
+
+    Accepts a JSON array (or {"transactions": [...]}) whose items are
+    {"sms_text": ..., "message_id": ...} objects or plain SMS strings. All
+    parsed messages are stored in one database transaction; one whose
+    message_id is already stored is reported as a duplicate, not stored again.
+    """
+    data = request.json
+    if isinstance(data, dict):
+        data = data.get('transactions')
+    if not isinstance(data, list):
+        return jsonify({'status': 'failed', 'error': 'Expected a JSON array of transactions'}), 400
+    if len(data) > MAX_TRANSACTION_BATCH:
+        return jsonify({'status': 'failed',
+                        'error': f'At most {MAX_TRANSACTION_BATCH} transactions per request'}), 413
+    
+    # Parse everything first, remembering where each message came from
+    entries = []
+    positions = []
+    response = [{'status': 'failed', 'error': 'Could not parse SMS'} for _ in data]
+    for position, item in enumerate(data):
+        sms_text = item.get('sms_text') if isinstance(item, dict) else item
+        message_id = item.get('message_id') if isinstance(item, dict) else None
+        if message_id is not None and not isinstance(message_id, str):
+            response[position]['error'] = 'message_id must be a string'
+            continue
+        transaction = parse_mpesa_sms(sms_text) if isinstance(sms_text, str) else None
+        if transaction:
+            entries.append((sms_text, transaction, message_id))
+            positions.append(position)
+    
+    try:
+        results = store_transactions(entries) if entries else []
+    except sqlite3.OperationalError as e:
+        return storage_unavailable(e)
+    announce_transactions(entries, results)
+    
+    for position, result in zip(positions, results):
+        response[position] = {'status': 'success', 'matched_order': result['order'] is not None,
+                              'duplicate': result['duplicate']}
+    
+    return jsonify({
+        'status': 'success',
+        'received': len(data),
+        'stored': sum(1 for result in results if not result['duplicate']),
+        'matched': sum(1 for result in results if result['order']),
+        'results': response
+    })
+
+@app.route('/api/events')
+@admin_required
+def events_stream():
+    """Server-Sent Events stream of order and payment updates for the dashboard"""
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    subscriber = event_broker.subscribe(last_event_id)
     
-    # Uncomment to start background checking
-    # checker_thread = threading.Thread(target=background_checker)
-    # checker_thread.daemon = True
-    # checker_thread.start()
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                event = subscriber.get()
+                if subscriber.overflowed:
+                    return
+                if event is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield format_sse(event)
+        finally:
+            event_broker.unsubscribe(subscriber)
     
-    app.run(host='0.0.0.0', port=1200, debug=True)
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+workers_start_on_request = False
+
+def create_app(config=None, start_workers=True):
+    """Prepare the module's app for serving and return it.
+
+    There is one app per process: this configures it rather than building
+    a new one.  Settings in config override the defaults and FLASK_<NAME>
+    environment variables read at import; the connection pool is rebuilt
+    so DATABASE and DB_POOL_* take effect.  Then migrates the schema and
+    starts the background workers, or, with start_workers=False, leaves
+    them to start with the first request each process handles.  Servers
+    that load the app once and fork workers (gunicorn --preload, see
+    wsgi.py) need the latter: threads do not survive a fork.
+    """
+    global workers_start_on_request
+    if config:
+        app.config.update(config)
+        db.init_app(app)
+    init_db()
+    if start_workers:
+        start_background_workers()
+    elif not workers_start_on_request:
+        app.before_request(_ensure_background_workers)
+        workers_start_on_request = True
+    return app
+
+def _ensure_background_workers():
+    if background_workers_pid != os.getpid():
+        start_background_workers()
+
+if __name__ == '__main__':
+    # Development server; see wsgi.py and gunicorn.conf.py for production
+    create_app().run(host='0.0.0.0', port=1200, debug=True)
@@ -3,20 +3,133 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.uix.button import Button
 from kivy.uix.textinput import TextInput
-from kivy.uix.scrollview import ScrollView
-from kivy.uix.gridlayout import GridLayout
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
 from kivy.clock import Clock
 from kivy.graphics import Color, Rectangle
 from kivy.core.window import Window
 from kivy.logger import Logger
+from kivy.utils import platform
 import requests
-import re
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
 from datetime import datetime
 import random
 
+from mpesa_parser import parse_mpesa_sms
+from outbox import Outbox, DeliveryWorker, SENT, RETRYING
+from sms_sources import create_sms_source
+
 # Set window background color
 Window.clearcolor = (0.95, 0.95, 0.95, 1)
 
+# Transactions kept in the on-screen list (older ones scroll off for good)
+MAX_RECENT_TRANSACTIONS = 200
+
+# SMS ids remembered for de-duplication
+MAX_SEEN_IDS = 5000
+SEEN_ID_TTL = 12 * 60 * 60  # seconds
+
+class RecentIds:
+    """Bounded LRU set of recently seen ids that also forgets ids after ttl seconds"""
+    
+    def __init__(self, maxlen=MAX_SEEN_IDS, ttl=SEEN_ID_TTL):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self._seen = OrderedDict()
+    
+    def __contains__(self, item_id):
+        seen_at = self._seen.get(item_id)
+        return seen_at is not None and time.monotonic() - seen_at < self.ttl
+    
+    def add(self, item_id):
+        now = time.monotonic()
+        self._seen[item_id] = now
+        self._seen.move_to_end(item_id)
+        # Oldest entries are at the front
+        while self._seen:
+            oldest_id, seen_at = next(iter(self._seen.items()))
+            if len(self._seen) <= self.maxlen and now - seen_at < self.ttl:
+                break
+            del self._seen[oldest_id]
+    
+    def __len__(self):
+        return len(self._seen)
+
+class TransactionCard(RecycleDataViewBehavior, BoxLayout):
+    """A transaction row in the RecycleView - created once and reused while scrolling"""
+    
+    def __init__(self, **kwargs):
+        super().__init__(orientation='vertical', padding=10, spacing=5, **kwargs)
+        
+        # Add background color
+        with self.canvas.before:
+            Color(0.2, 0.2, 0.3, 1)  # Dark blue card
+            self.background = Rectangle(pos=self.pos, size=self.size)
+        self.bind(pos=self.update_background, size=self.update_background)
+        
+        # Transaction details
+        details_layout = BoxLayout(orientation='horizontal', size_hint_y=0.7)
+        
+        # Left side: Basic info
+        left_info = BoxLayout(orientation='vertical', size_hint_x=0.6)
+        
+        self.name_label = Label(
+            size_hint_y=0.4,
+            color=(1, 1, 1, 1),
+            text_size=(200, None)
+        )
+        left_info.add_widget(self.name_label)
+        
+        self.amount_label = Label(
+            size_hint_y=0.3,
+            color=(0.5, 1, 0.5, 1),
+            bold=True
+        )
+        left_info.add_widget(self.amount_label)
+        
+        self.ref_label = Label(
+            size_hint_y=0.3,
+            color=(0.8, 0.8, 1, 1),
+            font_size='12sp'
+        )
+        left_info.add_widget(self.ref_label)
+        
+        details_layout.add_widget(left_info)
+        
+        # Right side: Timestamp
+        self.time_label = Label(
+            size_hint_x=0.4,
+            color=(1, 1, 1, 0.8),
+            font_size='12sp'
+        )
+        details_layout.add_widget(self.time_label)
+        
+        self.add_widget(details_layout)
+        
+        # Status bar
+        self.status_bar = Label(
+            size_hint_y=0.3,
+            font_size='11sp'
+        )
+        self.add_widget(self.status_bar)
+    
+    def update_background(self, *args):
+        self.background.pos = self.pos
+        self.background.size = self.size
+    
+    def refresh_view_attrs(self, rv, index, data):
+        """Show the transaction in data (one entry of the RecycleView's data)"""
+        self.name_label.text = f"👤 {data['sender_name']}"
+        self.amount_label.text = f"💰 KSh {data['amount']:,}"
+        self.ref_label.text = f"🔖 {data['reference']}"
+        self.time_label.text = f"🕒 {data['timestamp']}"
+        self.status_bar.text = data['status_text']
+        self.status_bar.color = data['status_color']
+
 class MpesaSMSForwarder(App):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -24,19 +137,33 @@ class MpesaSMSForwarder(App):
         self.server_ip = ""
         self.server_url = ""
         
-        # SMS tracking
-        self.received_sms = []
+        # SMS tracking - both bounded so memory stays flat over a long shift
+        self.recent_transactions = deque(maxlen=MAX_RECENT_TRANSACTIONS)
         self.is_monitoring = False
-        self.processed_ids = set()
-        
-        # Test mode - set to True for testing without real SMS
-        self.test_mode = True
+        self.processed_ids = RecentIds()
+        
+        # Test mode - simulated SMS instead of the phone's inbox. Set the
+        # MPESA_SMS_FIXTURE environment variable to replay a file instead.
+        self.test_mode = platform != 'android'
+        self.sms_source = None
+        
+        # Delivery - transactions are written to an on-disk outbox and sent
+        # by a background worker in batches of up to batch_size, at most
+        # batch_interval seconds after the first one was queued
+        self.batch_size = 20
+        self.batch_interval = 2
+        self.outbox = None
+        self.delivery_worker = None
+        # outbox id -> list entry showing that transaction
+        self.delivery_rows = {}
         
         # Track the initial message widget
         self.initial_message_widget = None
         
     def build(self):
         """Build the main application interface"""
+        self.start_delivery_worker()
+        
         # Main container
         main_layout = BoxLayout(orientation='vertical', padding=20, spacing=15)
         
@@ -67,6 +194,31 @@ class MpesaSMSForwarder(App):
         
         return main_layout
     
+    def start_delivery_worker(self):
+        """Open the outbox and start sending whatever is waiting in it"""
+        self.outbox = Outbox(os.path.join(self.user_data_dir, 'outbox.db'))
+        self.delivery_worker = DeliveryWorker(
+            self.outbox,
+            on_result=self.on_delivery_result,
+            batch_size=self.batch_size,
+            batch_interval=self.batch_interval
+        )
+        self.delivery_worker.start()
+        
+        waiting = len(self.outbox)
+        if waiting:
+            Logger.info(f"{waiting} transaction(s) waiting in outbox from last run")
+    
+    def on_stop(self):
+        """Stop the delivery worker; undelivered transactions stay in the outbox"""
+        if self.sms_source:
+            self.sms_source.stop()
+        if self.delivery_worker:
+            self.delivery_worker.stop()
+            self.delivery_worker.join(timeout=2)
+        if self.outbox:
+            self.outbox.close()
+    
     def create_header(self):
         """Create the app header with title and description"""
         header_layout = BoxLayout(orientation='vertical', size_hint=(1, 0.15))
@@ -186,17 +338,6 @@ class MpesaSMSForwarder(App):
         )
         trans_layout.add_widget(trans_title)
         
-        # Scrollable transactions area
-        scroll = ScrollView(size_hint=(1, 0.9))
-        
-        # Grid layout for transactions
-        self.transactions_grid = GridLayout(
-            cols=1,
-            spacing=10,
-            size_hint_y=None
-        )
-        self.transactions_grid.bind(minimum_height=self.transactions_grid.setter('height'))
-        
         # Initial message - store reference to this widget
         self.initial_message_widget = Label(
             text="No transactions yet.\nStart monitoring to see M-Pesa transactions here.",
@@ -205,10 +346,21 @@ class MpesaSMSForwarder(App):
             color=(0.8, 0.8, 0.8, 1),
             text_size=(400, None)
         )
-        self.transactions_grid.add_widget(self.initial_message_widget)
+        trans_layout.add_widget(self.initial_message_widget)
         
-        scroll.add_widget(self.transactions_grid)
-        trans_layout.add_widget(scroll)
+        # Recycled list - only the visible cards exist as widgets
+        self.transactions_view = RecycleView(size_hint=(1, 0.9))
+        self.transactions_view.viewclass = TransactionCard
+        transactions_layout = RecycleBoxLayout(
+            orientation='vertical',
+            spacing=10,
+            default_size=(None, 120),
+            default_size_hint=(1, None),
+            size_hint_y=None
+        )
+        transactions_layout.bind(minimum_height=transactions_layout.setter('height'))
+        self.transactions_view.add_widget(transactions_layout)
+        trans_layout.add_widget(self.transactions_view)
         
         return trans_layout
     
@@ -253,6 +405,13 @@ class MpesaSMSForwarder(App):
         # Construct full API URL
         self.server_ip = ip
         self.server_url = f"http://{ip}/api/add_transaction"
+        self.batch_url = f"http://{ip}/api/add_transactions"
+        self.delivery_worker.url = self.batch_url
+        # Batches refused at the old address get another chance
+        requeued = self.outbox.requeue_rejected()
+        if requeued:
+            Logger.info(f"Requeued {requeued} rejected transaction(s)")
+        self.delivery_worker.notify()
         
         self.server_status.text = f"✅ Server: {self.server_url}"
         self.server_status.color = (0.5, 1, 0.5, 1)
@@ -279,8 +438,13 @@ class MpesaSMSForwarder(App):
         self.status_indicator.text = "🔍 SCANNING..."
         self.status_indicator.color = (1, 1, 0.5, 1)
         
-        # Start checking for SMS every 2 seconds
-        self.monitor_event = Clock.schedule_interval(self.check_for_sms, 2)
+        # New SMS are pushed to on_new_sms by the source
+        self.sms_source = create_sms_source(
+            self.user_data_dir,
+            test_mode=self.test_mode,
+            fixture_path=os.environ.get('MPESA_SMS_FIXTURE')
+        )
+        self.sms_source.start(self.on_new_sms)
         
         Logger.info("M-Pesa SMS monitoring started")
     
@@ -292,68 +456,55 @@ class MpesaSMSForwarder(App):
         self.status_indicator.text = "⏸️ READY"
         self.status_indicator.color = (1, 1, 1, 1)
         
-        if hasattr(self, 'monitor_event'):
-            self.monitor_event.cancel()
+        if self.sms_source:
+            self.sms_source.stop()
+            self.sms_source = None
         
         Logger.info("M-Pesa SMS monitoring stopped")
     
-    def check_for_sms(self, dt):
+    def on_new_sms(self, new_sms_list):
+        """Called by the SMS source, possibly from a background thread"""
+        Clock.schedule_once(lambda dt: self.check_for_sms(new_sms_list))
+    
+    def on_resume(self):
+        """Pick up SMS that arrived while the app was in the background"""
+        if self.sms_source:
+            self.sms_source.catch_up()
+        return True
+    
+    def check_for_sms(self, new_sms_list):
         """
-        Main SMS checking function
-        This runs every 2 seconds when monitoring is active
+        Main SMS handling function
+        Runs on the UI thread whenever the source delivers new messages
         """
         try:
             # Update status with current time
             current_time = datetime.now().strftime("%H:%M:%S")
-            self.status_indicator.text = f"🔍 Scanning... {current_time}"
+            self.status_indicator.text = f"📥 Last SMS {current_time}"
             
-            # Get new SMS messages
-            new_sms_list = self.get_new_sms_messages()
-            
-            # Process each new SMS
+            # Process each new SMS, skipping any we have already seen
+            handled = []
             for sms_data in new_sms_list:
-                self.process_sms_message(sms_data)
+                if sms_data['id'] not in self.processed_ids:
+                    if not self.process_sms_message(sms_data):
+                        # Not queued; the source delivers it again next start
+                        continue
+                    self.processed_ids.add(sms_data['id'])
+                handled.append(sms_data)
+            
+            # Only now may the source move its saved position past them
+            if self.sms_source:
+                self.sms_source.acknowledge(handled)
                 
         except Exception as e:
             Logger.error(f"Error in SMS check: {e}")
             self.status_indicator.text = f"❌ Error: {str(e)[:20]}..."
     
-    def get_new_sms_messages(self):
-        """
-        Get new SMS messages from the device
-        In production, this would read from Android SMS content provider
-        """
-        new_sms = []
-        
-        if self.test_mode:
-            # TEST MODE: Simulate occasional M-Pesa messages
-            # Comment out this entire if block in production
-            if random.random() < 0.05:  # 5% chance to generate test message
-                test_messages = [
-                    "Ksh1,230 from JOHN KAMAU on 15/12/24 RefORD001",
-                    "Ksh4,560 from MARY WANJIKU on 15/12/24 RefORD002",
-                    "Ksh3,210 from PETER NJOROGE on 15/12/24 RefORD003",
-                    "Confirmed. Ksh8,900 paid to BUSINESS. RefORD004",
-                    "DAVID KIPTOO sent you Ksh2,340. Reference: ORD005"
-                ]
-                test_msg = random.choice(test_messages)
-                if test_msg not in self.processed_ids:
-                    new_sms.append({
-                        'id': test_msg,  # Using message as ID for simulation
-                        'text': test_msg,
-                        'timestamp': datetime.now()
-                    })
-                    self.processed_ids.add(test_msg)
-        
-        # TODO: REPLACE WITH ACTUAL SMS READING CODE FOR PRODUCTION
-        # This is where you would implement reading real SMS from Android
-        # Example implementation would use Android's SMS content provider
-        
-        return new_sms
-    
     def process_sms_message(self, sms_data):
         """
         Process an SMS message: parse, display, and forward to server
+        Returns False if the message could not be queued and should be
+        read again, True once it is dealt with
         """
         try:
             sms_text = sms_data['text']
@@ -367,12 +518,10 @@ class MpesaSMSForwarder(App):
                 self.display_transaction(parsed_data, sms_text)
                 
                 # Forward to server
-                self.forward_to_server(sms_text, parsed_data)
-                
-                return True
+                return self.forward_to_server(sms_text, parsed_data)
             else:
                 Logger.warning(f"Not a valid M-Pesa SMS: {sms_text}")
-                return False
+                return True
                 
         except Exception as e:
             Logger.error(f"Error processing SMS: {e}")
@@ -384,188 +533,123 @@ class MpesaSMSForwarder(App):
                 'timestamp': datetime.now().strftime("%H:%M:%S")
             }
             self.display_transaction(error_data, f"Error: {str(e)}")
-            return False
+            # Reading it again would fail the same way
+            return True
     
     def parse_mpesa_transaction(self, sms_text):
         """
         Parse M-Pesa SMS to extract transaction details
         Returns: dict with 'sender_name', 'amount', 'reference', 'timestamp'
         """
-        patterns = [
-            # Pattern 1: "Ksh1,000 from JOHN DOE on 12/12/24 RefABC123"
-            r"Ksh([\d,]+)\.?\s*from\s*(.*?)\s*on\s*\d+/\d+/\d+.*?Ref(\w+)",
-            
-            # Pattern 2: "Confirmed. Ksh500.00 paid to BUSINESS. RefXYZ789"  
-            r"Confirmed\.\s*Ksh([\d,]+)\.\d+\s*paid to.*?Ref(\w+)",
-            
-            # Pattern 3: "JOHN DOE sent you Ksh1,500. Reference: REF456"
-            r"(.*?)\s*sent you\s*Ksh([\d,]+).*?Reference:\s*(\w+)",
-            
-            # Pattern 4: Generic M-Pesa format
-            r"Ksh([\d,]+)\.?\s*received from\s*(.*?)\s*.*?Ref(\w+)"
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, sms_text, re.IGNORECASE)
-            if match:
-                groups = match.groups()
-                if len(groups) == 3:
-                    # Extract data based on pattern type
-                    if 'sent you' in sms_text:
-                        # Format: "JOHN DOE sent you Ksh1,500"
-                        sender_name = groups[0].strip().title()
-                        amount = int(groups[1].replace(',', ''))
-                        reference = groups[2].strip()
-                    else:
-                        # Format: "Ksh1,000 from JOHN DOE"
-                        sender_name = groups[1].strip().title()
-                        amount = int(groups[0].replace(',', ''))
-                        reference = groups[2].strip()
-                    
-                    return {
-                        'sender_name': sender_name,
-                        'amount': amount,
-                        'reference': reference,
-                        'timestamp': datetime.now().strftime("%H:%M:%S")
-                    }
-        
-        # No pattern matched
-        return None
+        # Same parser the server uses, so both sides agree on every format
+        transaction = parse_mpesa_sms(sms_text)
+        
+        if transaction is None:
+            # No pattern matched
+            return None
+        
+        return {
+            'sender_name': transaction.sender_name,
+            'amount': transaction.amount,
+            'reference': transaction.reference,
+            'timestamp': datetime.now().strftime("%H:%M:%S")
+        }
     
     def display_transaction(self, transaction_data, raw_sms):
         """
-        Display a transaction in the transactions grid
+        Display a transaction at the top of the transactions list
         """
         # Remove initial message if it exists
-        if (self.initial_message_widget and 
-            self.initial_message_widget in self.transactions_grid.children):
-            self.transactions_grid.remove_widget(self.initial_message_widget)
+        if self.initial_message_widget and self.initial_message_widget.parent:
+            self.initial_message_widget.parent.remove_widget(self.initial_message_widget)
             self.initial_message_widget = None
         
-        # Create transaction card
-        card = BoxLayout(
-            orientation='vertical',
-            size_hint_y=None,
-            height=120,
-            padding=10,
-            spacing=5
-        )
-        
-        # Add background color based on status
-        with card.canvas.before:
-            Color(0.2, 0.2, 0.3, 1)  # Dark blue card
-            Rectangle(pos=card.pos, size=card.size)
-        
-        # Transaction details
-        details_layout = BoxLayout(orientation='horizontal', size_hint_y=0.7)
-        
-        # Left side: Basic info
-        left_info = BoxLayout(orientation='vertical', size_hint_x=0.6)
-        
-        name_label = Label(
-            text=f"👤 {transaction_data['sender_name']}",
-            size_hint_y=0.4,
-            color=(1, 1, 1, 1),
-            text_size=(200, None)
-        )
-        left_info.add_widget(name_label)
-        
-        amount_label = Label(
-            text=f"💰 KSh {transaction_data['amount']:,}",
-            size_hint_y=0.3,
-            color=(0.5, 1, 0.5, 1),
-            bold=True
-        )
-        left_info.add_widget(amount_label)
-        
-        ref_label = Label(
-            text=f"🔖 {transaction_data['reference']}",
-            size_hint_y=0.3,
-            color=(0.8, 0.8, 1, 1),
-            font_size='12sp'
-        )
-        left_info.add_widget(ref_label)
-        
-        details_layout.add_widget(left_info)
-        
-        # Right side: Timestamp
-        time_label = Label(
-            text=f"🕒 {transaction_data['timestamp']}",
-            size_hint_x=0.4,
-            color=(1, 1, 1, 0.8),
-            font_size='12sp'
-        )
-        details_layout.add_widget(time_label)
-        
-        card.add_widget(details_layout)
-        
-        # Status bar
-        status_bar = Label(
-            text="📤 Forwarding to server...",
-            size_hint_y=0.3,
-            color=(1, 1, 0.5, 1),
-            font_size='11sp'
-        )
-        card.add_widget(status_bar)
-        
-        # Add to transactions grid (at the top)
-        self.transactions_grid.add_widget(card, index=0)
-        
-        # Store for reference
-        self.received_sms.append({
-            'card': card,
-            'status_bar': status_bar,
-            'data': transaction_data
+        # The ring buffer drops the oldest entry once it is full
+        if len(self.recent_transactions) == self.recent_transactions.maxlen:
+            evicted = self.recent_transactions[-1]
+            self.delivery_rows.pop(evicted.get('entry_id'), None)
+        
+        self.recent_transactions.appendleft({
+            'sender_name': transaction_data['sender_name'],
+            'amount': transaction_data['amount'],
+            'reference': transaction_data['reference'],
+            'timestamp': transaction_data['timestamp'],
+            'status_text': "📤 Forwarding to server...",
+            'status_color': (1, 1, 0.5, 1)
         })
+        self.transactions_view.data = list(self.recent_transactions)
+    
+    def set_row_status(self, row, status_text, color):
+        """Change the status line of a list entry and redraw the visible cards"""
+        row['status_text'] = status_text
+        row['status_color'] = color
+        self.transactions_view.refresh_from_data()
+    
+    def build_payload(self, sms_text, parsed_data):
+        """Build the JSON body the server expects for one transaction"""
+        return {
+            # Stored with the payload in the outbox, so every resend of
+            # this message carries the same id
+            'message_id': uuid.uuid4().hex,
+            'sms_text': sms_text,
+            'parsed_data': parsed_data,
+            'timestamp': datetime.now().isoformat(),
+            'device': 'kivy_auto_app'
+        }
     
     def forward_to_server(self, sms_text, parsed_data):
         """
-        Forward transaction data to the server API
+        Queue transaction data for the server API
+        The delivery worker sends it in the background and retries until
+        the server has accepted it.  Returns True once it is in the outbox
         """
         try:
-            payload = {
-                'sms_text': sms_text,
-                'parsed_data': parsed_data,
-                'timestamp': datetime.now().isoformat(),
-                'device': 'kivy_auto_app'
-            }
+            entry_id = self.outbox.put(self.build_payload(sms_text, parsed_data))
             
-            Logger.info(f"Sending to server: {parsed_data}")
+            if self.recent_transactions:
+                row = self.recent_transactions[0]
+                row['entry_id'] = entry_id
+                self.delivery_rows[entry_id] = row
+                self.set_row_status(row, "📦 Queued for sending...", (1, 1, 0.5, 1))
             
-            # Send HTTP POST request
-            response = requests.post(
-                self.server_url,
-                json=payload,
-                headers={'Content-Type': 'application/json'},
-                timeout=5
-            )
+            Logger.info(f"Queued for server: {parsed_data}")
+            self.delivery_worker.notify()
+            return True
             
-            # Update status based on response
-            if self.received_sms:
-                status_bar = self.received_sms[-1]['status_bar']
-                
-                if response.status_code == 200:
-                    status_bar.text = "✅ Successfully sent to server!"
-                    status_bar.color = (0.5, 1, 0.5, 1)
-                    Logger.info("Transaction successfully forwarded to server")
-                else:
-                    status_bar.text = f"❌ Server error: {response.status_code}"
-                    status_bar.color = (1, 0.5, 0.5, 1)
-                    Logger.error(f"Server returned error: {response.status_code}")
-                    
-        except requests.exceptions.ConnectionError:
-            self.update_transaction_status("❌ Cannot connect to server")
-            Logger.error("Connection error - check server IP and network")
         except Exception as e:
             self.update_transaction_status(f"❌ Error: {str(e)[:30]}...")
-            Logger.error(f"Error sending to server: {e}")
+            Logger.error(f"Error queueing transaction: {e}")
+            return False
+    
+    def on_delivery_result(self, entry_id, status, message):
+        """Called by the delivery worker thread after each attempt"""
+        if status == SENT:
+            Logger.info(f"Transaction {entry_id} forwarded to server")
+        else:
+            Logger.error(f"Transaction {entry_id}: {message}")
+        # Widgets may only be touched from the UI thread
+        Clock.schedule_once(lambda dt: self.show_delivery_result(entry_id, status, message))
+    
+    def show_delivery_result(self, entry_id, status, message):
+        """Update the card of a transaction with its delivery status"""
+        row = self.delivery_rows.get(entry_id)
+        if row is None:
+            return
+        
+        if status == SENT:
+            self.set_row_status(row, f"✅ {message}", (0.5, 1, 0.5, 1))
+        elif status == RETRYING:
+            self.set_row_status(row, f"⏳ {message}", (1, 1, 0.5, 1))
+        else:
+            self.set_row_status(row, f"❌ {message}", (1, 0.5, 0.5, 1))
+        
+        if status != RETRYING:
+            del self.delivery_rows[entry_id]
     
     def update_transaction_status(self, status_text):
         """Update the status of the most recent transaction"""
-        if self.received_sms:
-            status_bar = self.received_sms[-1]['status_bar']
-            status_bar.text = status_text
-            status_bar.color = (1, 0.5, 0.5, 1)
+        if self.recent_transactions:
+            self.set_row_status(self.recent_transactions[0], status_text, (1, 0.5, 0.5, 1))
     
     # =========================================================================
     # TESTING FUNCTIONS - CAN BE COMMENTED OUT IN PRODUCTION
@@ -0,0 +1,75 @@
+"""M-Pesa SMS parser shared by the forwarder app and the Flask server.
+
+Every supported message format is registered once with a cheap keyword and
+a precompiled regular expression.  Parsing an SMS lower-cases it once,
+skips every format whose keyword is absent and only runs the regexes that
+can possibly match, so most messages cost a single regex search.
+
+Formats use named groups: ``amount`` and ``reference`` are required,
+``name`` is optional (outgoing "paid to" confirmations carry no sender).
+"""
+import re
+from collections import namedtuple
+
+MpesaTransaction = namedtuple('MpesaTransaction', 'amount sender_name reference format')
+
+_AMOUNT = r"Ksh\s?(?P<amount>[\d,]+)(?:\.\d+)?"
+_REFERENCE = r"Ref(?:erence)?[:\s]*(?P<reference>\w+)"
+
+# (name, keyword, compiled pattern), tried in registration order
+_FORMATS = []
+
+
+def register_format(name, keyword, pattern):
+    """Register an SMS format.
+
+    keyword is a lower-case substring that must appear in the message for
+    the pattern to be tried at all.
+    """
+    _FORMATS.append((name, keyword.lower(), re.compile(pattern, re.IGNORECASE | re.DOTALL)))
+
+
+# "JOHN DOE sent you Ksh1,500. Reference: REF456"
+register_format('sent_you', 'sent you',
+                r"(?P<name>[^.\n]*?)\s*sent you\s*" + _AMOUNT + r".*?" + _REFERENCE)
+
+# "Confirmed. Ksh500.00 paid to BUSINESS. RefXYZ789"
+register_format('paid_to', 'paid to',
+                _AMOUNT + r"\s*paid to.*?" + _REFERENCE)
+
+# "Ksh1,000 from JOHN DOE on 12/12/24 RefABC123"
+register_format('from_on', ' on ',
+                _AMOUNT + r"\s*(?:received\s+)?from\s*(?P<name>.*?)\s*on\s*\d+/\d+/\d+.*?" + _REFERENCE)
+
+# "Ksh1,000 received from JOHN DOE 0712345678 RefABC123" and other
+# messages that name the sender after "from"
+register_format('from', 'from',
+                _AMOUNT + r".*?from\s+(?P<name>[A-Za-z][A-Za-z '-]*?)"
+                r"(?=\s+\d|\s+on\s|\s*\.|\s*Ref).*?" + _REFERENCE)
+
+
+def parse_mpesa_sms(sms_text):
+    """Parse an M-Pesa SMS.
+
+    Returns an MpesaTransaction, or None if the text is not a recognised
+    M-Pesa payment message.
+    """
+    if not sms_text:
+        return None
+    lowered = sms_text.lower()
+    if 'ksh' not in lowered:
+        return None
+
+    for name, keyword, regex in _FORMATS:
+        if keyword not in lowered:
+            continue
+        match = regex.search(sms_text)
+        if match:
+            groups = match.groupdict()
+            return MpesaTransaction(
+                amount=int(groups['amount'].replace(',', '')),
+                sender_name=(groups.get('name') or '').strip().title(),
+                reference=groups['reference'].strip(),
+                format=name
+            )
+    return None
@@ -0,0 +1,221 @@
+"""Persistent outbox and background delivery for forwarded transactions.
+
+The UI thread only appends payloads to an on-disk SQLite outbox; a
+``DeliveryWorker`` thread sends them to the server in batches over a
+keep-alive ``requests.Session``.  Failed batches stay in the outbox and are
+retried with exponential backoff, so nothing is lost when the server is
+down and the UI never waits on the network.
+
+A batch the server refuses outright (a 4xx other than 408/429) would fail
+the same way forever, so it is parked instead: kept in the outbox with its
+error but no longer sent, until ``requeue_rejected`` is called after the
+settings change.  Each payload carries a ``message_id`` that the server
+uses to drop resends whose first response was lost.
+"""
+import json
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+
+# Delivery results reported to DeliveryWorker.on_result
+SENT = 'sent'
+REJECTED = 'rejected'
+RETRYING = 'retrying'
+
+
+class Outbox:
+    """Append-only queue of payloads waiting to be delivered, stored in SQLite"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS outbox
+                              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               payload TEXT,
+                               attempts INTEGER DEFAULT 0,
+                               next_attempt REAL,
+                               created_at REAL,
+                               rejected_at REAL,
+                               error TEXT)''')
+        # Outboxes created before refused batches were parked
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(outbox)')}
+        for column, kind in (('rejected_at', 'REAL'), ('error', 'TEXT')):
+            if column not in columns:
+                self._conn.execute(f'ALTER TABLE outbox ADD COLUMN {column} {kind}')
+        self._conn.commit()
+
+    def put(self, payload):
+        """Persist a payload and return its outbox id"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO outbox (payload, next_attempt, created_at) VALUES (?, ?, ?)',
+                (json.dumps(payload), now, now))
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def due(self, limit, now=None):
+        """Return up to limit entries ready to send as (id, payload, attempts, created_at)"""
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._conn.execute(
+                '''SELECT id, payload, attempts, created_at FROM outbox
+                   WHERE rejected_at IS NULL AND next_attempt <= ?
+                   ORDER BY id LIMIT ?''', (now, limit)).fetchall()
+        return [(entry_id, json.loads(payload), attempts, created_at)
+                for entry_id, payload, attempts, created_at in rows]
+
+    def next_attempt_at(self):
+        """Time of the earliest scheduled attempt, or None if nothing is waiting"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT MIN(next_attempt) FROM outbox WHERE rejected_at IS NULL').fetchone()[0]
+
+    def remove(self, ids):
+        with self._lock:
+            self._conn.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in ids])
+            self._conn.commit()
+
+    def reschedule(self, entries):
+        """entries is a list of (id, attempts, next_attempt)"""
+        with self._lock:
+            self._conn.executemany('UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?',
+                                   [(attempts, next_attempt, i) for i, attempts, next_attempt in entries])
+            self._conn.commit()
+
+    def reject(self, ids, error):
+        """Park entries the server refused so they are no longer sent"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany('UPDATE outbox SET rejected_at = ?, error = ? WHERE id = ?',
+                                   [(now, error, i) for i in ids])
+            self._conn.commit()
+
+    def requeue_rejected(self):
+        """Send parked entries again, e.g. after the server address changed"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                '''UPDATE outbox SET rejected_at = NULL, error = NULL, attempts = 0, next_attempt = ?
+                   WHERE rejected_at IS NOT NULL''', (now,))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def __len__(self):
+        """Number of entries still waiting to be sent"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM outbox WHERE rejected_at IS NULL').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DeliveryWorker(threading.Thread):
+    """Sends outbox entries to the server's bulk endpoint in the background.
+
+    on_result(outbox_id, status, message) is called from this thread for
+    every entry after each attempt, with status one of SENT, REJECTED
+    (refused by the server; not retried) or RETRYING.  Callers that touch
+    widgets must hop back to the UI thread themselves.
+    """
+
+    def __init__(self, outbox, on_result=None, batch_size=20, batch_interval=2,
+                 timeout=5, base_delay=1, max_delay=60):
+        super().__init__(daemon=True)
+        self.outbox = outbox
+        self.on_result = on_result
+        self.url = None
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.session = requests.Session()
+        self.session.headers['Content-Type'] = 'application/json'
+        self._wake = threading.Event()
+        self._stopping = False
+
+    def notify(self):
+        """Wake the worker, e.g. after putting a new entry in the outbox"""
+        self._wake.set()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+
+    def _report(self, entry_id, status, message):
+        if self.on_result:
+            self.on_result(entry_id, status, message)
+
+    def _backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        # Full jitter so several phones don't retry in lockstep
+        return random.uniform(delay / 2, delay)
+
+    def _wait(self, timeout):
+        self._wake.wait(timeout)
+        self._wake.clear()
+
+    def run(self):
+        while not self._stopping:
+            entries = self.outbox.due(self.batch_size) if self.url else []
+            if not entries:
+                next_attempt = self.outbox.next_attempt_at() if self.url else None
+                self._wait(None if next_attempt is None else max(0, next_attempt - time.time()))
+                continue
+
+            # Give a partial batch of fresh messages a moment to fill up
+            age = time.time() - entries[0][3]
+            if len(entries) < self.batch_size and entries[0][2] == 0 and age < self.batch_interval:
+                self._wait(self.batch_interval - age)
+                continue
+
+            self._send(entries)
+
+        self.session.close()
+
+    def _send(self, entries):
+        try:
+            response = self.session.post(
+                self.url,
+                json={'transactions': [payload for _, payload, _, _ in entries]},
+                timeout=self.timeout
+            )
+            if response.status_code == 200:
+                results = response.json().get('results', [])
+                self.outbox.remove([entry_id for entry_id, _, _, _ in entries])
+                for (entry_id, _, _, _), result in zip(entries, results):
+                    if result.get('status') == 'success':
+                        self._report(entry_id, SENT, "Successfully sent to server!")
+                    else:
+                        # Delivered but not understood - retrying won't help
+                        self._report(entry_id, REJECTED, result.get('error', 'Rejected by server'))
+                return
+            if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                # The same request would be refused again; park it rather
+                # than retrying forever
+                error = f"Rejected by server: {response.status_code}"
+                self.outbox.reject([entry_id for entry_id, _, _, _ in entries], error)
+                for entry_id, _, _, _ in entries:
+                    self._report(entry_id, REJECTED, error)
+                return
+            error = f"Server error: {response.status_code}"
+        except requests.exceptions.ConnectionError:
+            error = "Cannot connect to server"
+        except Exception as e:
+            error = f"Error: {str(e)[:30]}"
+
+        now = time.time()
+        retries = []
+        for entry_id, _, attempts, _ in entries:
+            delay = self._backoff(attempts + 1)
+            retries.append((entry_id, attempts + 1, now + delay))
+            self._report(entry_id, RETRYING, f"{error} - retrying in {delay:.0f}s")
+        self.outbox.reschedule(retries)
@@ -0,0 +1,290 @@
+"""Where the forwarder gets its SMS from.
+
+Every source delivers new messages to a callback as lists of
+``{'id', 'text', 'timestamp'}`` dicts, oldest first.  The callback may be
+invoked from a non-UI thread.  Once a message is safely stored (queued in
+the outbox) the app passes it back to ``acknowledge``; a source that
+remembers its position across restarts only moves it past acknowledged
+messages, so one that was read but never stored is read again next start.
+
+* ``AndroidInboxSource`` reads the device inbox incrementally from the last
+  seen ``_id`` and is woken by the SMS_RECEIVED broadcast, so nothing runs
+  while no SMS arrive.
+* ``PollingSource`` wraps any source with ``read_new()`` and calls it on a
+  fixed interval - the fallback when the broadcast receiver is unavailable.
+* ``FileSource`` reads a fixture file (one SMS per line) for testing on a
+  desktop; poll it with ``PollingSource``.
+* ``SimulatedSource`` produces random test messages.
+"""
+import os
+import random
+import threading
+from datetime import datetime
+
+from kivy.clock import Clock
+from kivy.logger import Logger
+
+SMS_RECEIVED = 'android.provider.Telephony.SMS_RECEIVED'
+
+
+class SmsSource:
+    """Base class for SMS sources"""
+
+    def __init__(self):
+        self.callback = None
+
+    def start(self, callback):
+        self.callback = callback
+        self.catch_up()
+
+    def stop(self):
+        self.callback = None
+
+    def read_new(self):
+        """Return messages that arrived since the previous call"""
+        return []
+
+    def acknowledge(self, messages):
+        """Called once the delivered messages have been stored"""
+
+    def catch_up(self):
+        """Deliver anything that arrived while the source was not watching"""
+        self.deliver(self.read_new())
+
+    def deliver(self, messages):
+        if messages and self.callback:
+            self.callback(messages)
+
+
+class PollingSource(SmsSource):
+    """Calls another source's read_new() every interval seconds"""
+
+    def __init__(self, source, interval=2):
+        super().__init__()
+        self.source = source
+        self.interval = interval
+        self._event = None
+
+    def read_new(self):
+        return self.source.read_new()
+
+    def acknowledge(self, messages):
+        self.source.acknowledge(messages)
+
+    def start(self, callback):
+        super().start(callback)
+        self._event = Clock.schedule_interval(lambda dt: self.catch_up(), self.interval)
+
+    def stop(self):
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+        super().stop()
+
+
+class AndroidInboxSource(SmsSource):
+    """Reads the Android SMS inbox, woken by the SMS_RECEIVED broadcast.
+
+    The ``_id`` up to which every message has been acknowledged is kept in
+    state_path, so messages that arrive while the app is closed, or that
+    were read but not stored before it stopped, are delivered on the next
+    start.  On first run only messages newer than the current inbox are
+    delivered.
+    """
+
+    def __init__(self, state_path, senders=('MPESA',)):
+        super().__init__()
+        from jnius import autoclass
+
+        self.state_path = state_path
+        self.senders = {sender.upper() for sender in senders} if senders else None
+        self._lock = threading.Lock()
+        self._receiver = None
+
+        activity = autoclass('org.kivy.android.PythonActivity').mActivity
+        self._resolver = activity.getContentResolver()
+        self._uri = autoclass('android.net.Uri').parse('content://sms/inbox')
+        # Saved position, and how far this run has read; loaded on the first
+        # read, once the READ_SMS permission is granted
+        self.last_id = None
+        self._read_id = None
+        # Ids delivered but not yet acknowledged
+        self._unacked = set()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            pass
+        # First run: start after the newest message already on the phone
+        cursor = self._resolver.query(self._uri, ['_id'], None, None, '_id DESC')
+        last_id = 0
+        if cursor is not None:
+            try:
+                if cursor.moveToFirst():
+                    last_id = cursor.getLong(0)
+            finally:
+                cursor.close()
+        return last_id
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(self.last_id))
+        os.replace(tmp_path, self.state_path)
+
+    def _advance(self):
+        """Move the saved position up to the oldest unacknowledged message"""
+        last_id = min(self._unacked) - 1 if self._unacked else self._read_id
+        if last_id != self.last_id:
+            self.last_id = last_id
+            self._save_state()
+
+    def read_new(self):
+        messages = []
+        with self._lock:
+            try:
+                if self._read_id is None:
+                    self.last_id = self._read_id = self._load_state()
+                    # Pin the first run's starting point before anything
+                    # newer is read
+                    self._save_state()
+                cursor = self._resolver.query(self._uri, ['_id', 'address', 'body', 'date'],
+                                              '_id > ?', [str(self._read_id)], '_id ASC')
+            except Exception as e:
+                # Usually the permission prompt has not been answered yet
+                Logger.warning(f"Cannot read SMS inbox: {e}")
+                return messages
+            if cursor is None:
+                return messages
+            try:
+                while cursor.moveToNext():
+                    sms_id = cursor.getLong(0)
+                    self._read_id = max(self._read_id, sms_id)
+                    address = (cursor.getString(1) or '').upper()
+                    if self.senders and address not in self.senders:
+                        continue
+                    messages.append({
+                        'id': sms_id,
+                        'text': cursor.getString(2) or '',
+                        'timestamp': datetime.fromtimestamp(cursor.getLong(3) / 1000)
+                    })
+                    self._unacked.add(sms_id)
+            finally:
+                cursor.close()
+            # Skipped messages from other senders need no acknowledgement
+            self._advance()
+        return messages
+
+    def acknowledge(self, messages):
+        with self._lock:
+            self._unacked.difference_update(message['id'] for message in messages)
+            self._advance()
+
+    def start(self, callback):
+        from android.broadcast import BroadcastReceiver
+
+        self._receiver = BroadcastReceiver(self._on_sms_received, actions=[SMS_RECEIVED])
+        self._receiver.start()
+        super().start(callback)
+
+    def stop(self):
+        if self._receiver is not None:
+            self._receiver.stop()
+            self._receiver = None
+        super().stop()
+
+    def _on_sms_received(self, context, intent):
+        messages = self.read_new()
+        if messages:
+            self.deliver(messages)
+        else:
+            # The broadcast can arrive before the SMS is written to the inbox
+            Clock.schedule_once(lambda dt: self.catch_up(), 1)
+
+
+class FileSource(SmsSource):
+    """Reads SMS from a text file, one message per line, as lines are appended.
+
+    Lines are identified by their byte offset, so restarting with the same
+    file replays it from the beginning.  Wrap it in a PollingSource; an idle
+    poll costs a single stat().
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._offset = 0
+
+    def read_new(self):
+        try:
+            if os.path.getsize(self.path) <= self._offset:
+                return []
+        except OSError:
+            return []
+
+        messages = []
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Still being written
+                line_offset = self._offset
+                self._offset += len(line)
+                text = line.decode('utf-8').strip()
+                if text:
+                    messages.append({
+                        'id': f"{self.path}:{line_offset}",
+                        'text': text,
+                        'timestamp': datetime.now()
+                    })
+        return messages
+
+
+class SimulatedSource(SmsSource):
+    """Occasionally produces one of a few canned M-Pesa messages"""
+
+    TEST_MESSAGES = [
+        "Ksh1,230 from JOHN KAMAU on 15/12/24 RefORD001",
+        "Ksh4,560 from MARY WANJIKU on 15/12/24 RefORD002",
+        "Ksh3,210 from PETER NJOROGE on 15/12/24 RefORD003",
+        "Confirmed. Ksh8,900 paid to BUSINESS. RefORD004",
+        "DAVID KIPTOO sent you Ksh2,340. Reference: ORD005"
+    ]
+
+    def __init__(self, probability=0.05):
+        super().__init__()
+        self.probability = probability
+
+    def read_new(self):
+        if random.random() >= self.probability:
+            return []
+        test_msg = random.choice(self.TEST_MESSAGES)
+        return [{
+            'id': test_msg,  # Using message as ID for simulation
+            'text': test_msg,
+            'timestamp': datetime.now()
+        }]
+
+
+def create_sms_source(state_dir, test_mode=False, fixture_path=None):
+    """Pick the best SMS source for this platform"""
+    from kivy.utils import platform
+
+    if fixture_path:
+        return PollingSource(FileSource(fixture_path), interval=1)
+
+    if platform == 'android' and not test_mode:
+        from android.permissions import Permission, request_permissions
+        request_permissions([Permission.READ_SMS, Permission.RECEIVE_SMS])
+
+        inbox = AndroidInboxSource(os.path.join(state_dir, 'sms_last_id'))
+        try:
+            from android.broadcast import BroadcastReceiver  # noqa: F401
+            return inbox
+        except ImportError:
+            Logger.warning("SMS broadcast receiver unavailable - polling the inbox instead")
+            return PollingSource(inbox)
+
+    return PollingSource(SimulatedSource())
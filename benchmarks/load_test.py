@@ -0,0 +1,349 @@
+"""Load-test the server with a simulated lunch rush.
+
+Each of --concurrency customers places orders in a loop (POST /order) and,
+most of the time, pays for them: the SMS forwarder then posts the M-Pesa
+message (POST /api/add_transaction).  Some customers mistype the reference
+so only their name and amount can match, some never pay, and a share of
+the SMS are not for any order at all.  Meanwhile --cashiers poll
+GET /api/check_payments and --admins keep the dashboard open, refreshing
+/api/dashboard with since= and If-None-Match as the page does.
+
+Reports throughput, p50/p95/p99 latency, HTTP errors and SQLite lock
+errors per endpoint, and how many of the payments that should have matched
+did.  Lock errors are read from the server's log, so they are only counted
+with --serve (which starts the server from a fresh database in a temporary
+directory) or when the server's stderr is passed as --server-log.  Save a
+run with --output and compare later ones against it with --baseline.
+
+    python benchmarks/load_test.py --serve [--duration 30] [--concurrency 16]
+        [--cashiers 1] [--admins 2] [--output baseline.json]
+    python benchmarks/load_test.py --url http://127.0.0.1:1200 [--server-log server.log]
+"""
+import argparse
+import collections
+import http.cookiejar
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_NAMES = ['JOHN', 'MARY', 'PETER', 'DAVID', 'GRACE', 'JANE', 'SAMUEL', 'FAITH',
+               'JAMES', 'ANN', 'JOSEPH', 'ESTHER', 'DANIEL', 'RUTH', 'MOSES', 'LUCY']
+LAST_NAMES = ['KAMAU', 'WANJIKU', 'NJOROGE', 'KIPTOO', 'OTIENO', 'ACHIENG', 'MUTUA',
+              'WAFULA', 'CHEBET', 'ODHIAMBO', 'NYAMBURA', 'KORIR', 'MWANGI', 'ATIENO']
+# Payment messages that are not for any order
+NOISE = [
+    "Ksh{amount} from {name} on {date} Ref{ref}",
+    "{name} sent you Ksh{amount}. Reference: {ref}",
+    "Your M-PESA balance is Ksh{amount}.00",
+]
+USSD_CODE = re.compile(r"\*144\*\d+\*(\d+)\*([0-9A-Za-z]+)#")
+# Flask logs "Exception on /path [METHOD]" followed by the traceback
+LOGGED_EXCEPTION = re.compile(r"Exception on (\S+) \[(\w+)\]")
+LOCK_ERRORS = ('database is locked', 'database table is locked',
+               'timed out waiting for a database connection')
+ADMIN_PASSWORD = 'Bingohotelbondo'
+
+
+class Recorder:
+    """Latencies and errors per endpoint, shared by every client thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+class Client:
+    """One browser or device: its own cookies, timed requests"""
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, endpoint, path, data=None, json_body=None, headers=None):
+        """Return (status, headers, body); endpoint names the row in the report"""
+        headers = dict(headers or {})
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            data = urllib.parse.urlencode(data, doseq=True).encode()
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                status, response_headers, body = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            status, response_headers, body = e.code, e.headers, e.read()
+        except OSError:
+            status, response_headers, body = None, {}, b''
+        self.recorder.record(endpoint, time.perf_counter() - start,
+                             status is not None and (status < 400))
+        return status, response_headers, body
+
+
+def random_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def sms_date():
+    return time.strftime('%d/%m/%y')
+
+
+def customer(client, menu, args, rng, stop, expected):
+    """Place orders and pay for most of them until stop is set"""
+    while not stop.is_set():
+        name = random_name(rng)
+        items = rng.sample(menu, rng.randint(1, min(3, len(menu))))
+        form = {'customer_name': name.title(), 'items': [str(item['id']) for item in items]}
+        for item in items:
+            form[f"qty_{item['id']}"] = str(rng.randint(1, 3))
+        status, _, body = client.request('POST /order', '/order', data=form)
+        match = USSD_CODE.search(body.decode('utf-8', 'replace')) if status == 200 else None
+        if match is None:
+            continue
+        amount, reference = match.groups()
+
+        roll = rng.random()
+        if roll >= args.unpaid_rate:
+            if roll < args.unpaid_rate + args.typo_rate:
+                # Only the name and amount can match this one
+                sent_reference = reference[:-1] + rng.choice('XYZ')
+            else:
+                sent_reference = reference
+            expected.append(reference)
+            sms = f"Ksh{amount} from {name} on {sms_date()} Ref{sent_reference}"
+            client.request('POST /api/add_transaction', '/api/add_transaction',
+                           json_body={'sms_text': sms})
+
+        if rng.random() < args.noise_rate:
+            sms = rng.choice(NOISE).format(amount=rng.randint(10, 5000), name=random_name(rng),
+                                           date=sms_date(), ref=f"Q{rng.randrange(16 ** 8):08X}")
+            client.request('POST /api/add_transaction', '/api/add_transaction',
+                           json_body={'sms_text': sms})
+
+
+def cashier(client, args, stop):
+    while not stop.wait(args.poll_interval):
+        client.request('GET /api/check_payments', '/api/check_payments')
+
+
+def admin(client, args, stop):
+    """Keep the dashboard open: load the shell and snapshot, then refresh changes"""
+    client.request('POST /admin (login)', '/admin',
+                   data={'username': 'admin', 'password': args.admin_password})
+    version, etag = None, None
+    while not stop.is_set():
+        path = '/api/dashboard' if version is None else f'/api/dashboard?since={version}'
+        status, headers, body = client.request('GET /api/dashboard', path,
+                                               headers={'If-None-Match': etag} if etag else None)
+        if status == 200:
+            version, etag = json.loads(body)['version'], headers.get('ETag')
+        stop.wait(args.dashboard_interval)
+
+
+def count_lock_errors(log_text):
+    """Return {endpoint: count} of logged exceptions caused by SQLite locking"""
+    counts = collections.Counter()
+    endpoint, traceback = None, []
+
+    def flush():
+        if endpoint and any(error in line for line in traceback for error in LOCK_ERRORS):
+            counts[endpoint] += 1
+
+    for line in log_text.splitlines():
+        match = LOGGED_EXCEPTION.search(line)
+        if match:
+            flush()
+            path, method = match.groups()
+            endpoint, traceback = f"{method} {path}", []
+        elif endpoint:
+            traceback.append(line)
+    flush()
+    return counts
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def summarize(recorder, elapsed, lock_errors):
+    report = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        latencies = sorted(latencies)
+        report[endpoint] = {
+            'requests': len(latencies),
+            'per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'errors': recorder.errors[endpoint],
+            'lock_errors': lock_errors.get(endpoint.split(' (')[0], 0) if lock_errors is not None else None,
+        }
+    return report
+
+
+def print_report(report, baseline=None):
+    print(f"{'endpoint':<28}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'errors':>8}{'locked':>8}")
+    for endpoint, row in report.items():
+        locked = '-' if row['lock_errors'] is None else row['lock_errors']
+        print(f"{endpoint:<28}{row['requests']:>9,}{row['per_second']:>9.1f}{row['p50_ms']:>9.1f}"
+              f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['errors']:>8}{locked:>8}")
+        old = (baseline or {}).get(endpoint)
+        if old:
+            def change(key):
+                return f"{(row[key] / old[key] - 1) * 100:+.0f}%" if old[key] else 'n/a'
+            print(f"{'  vs baseline':<28}{'':>9}{change('per_second'):>9}{change('p50_ms'):>9}"
+                  f"{change('p95_ms'):>9}{change('p99_ms'):>9}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(directory, log_file):
+    """Run app.py's app from directory (so it gets a fresh orders.db); returns (process, url)"""
+    port = free_port()
+    code = (f"import sys; sys.path.insert(0, {REPO!r}); import app; "
+            f"app.create_app().run(host='127.0.0.1', port={port}, threaded=True)")
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=directory,
+                               stdout=log_file, stderr=subprocess.STDOUT)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def wait_for_menu(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(base_url + '/api/menu', timeout=5) as response:
+                return json.loads(response.read())['items']
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def paid_references(base_url):
+    with urllib.request.urlopen(base_url + '/api/orders?status=paid&fields=reference&format=ndjson',
+                                timeout=60) as response:
+        return {json.loads(line)['reference'] for line in response if line.strip()}
+
+
+def run(args, base_url):
+    menu = wait_for_menu(base_url)
+    recorder = Recorder()
+    stop = threading.Event()
+    expected = []
+    threads = []
+    for number in range(args.concurrency):
+        rng = random.Random(args.seed * 1000 + number)
+        threads.append(threading.Thread(target=customer, args=(Client(base_url, recorder), menu,
+                                                               args, rng, stop, expected)))
+    for _ in range(args.cashiers):
+        threads.append(threading.Thread(target=cashier, args=(Client(base_url, recorder), args, stop)))
+    for _ in range(args.admins):
+        threads.append(threading.Thread(target=admin, args=(Client(base_url, recorder), args, stop)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Give the background matcher a moment to catch up with the last payments
+    time.sleep(args.settle)
+    paid = paid_references(base_url)
+    matched = sum(1 for reference in expected if reference in paid)
+    return recorder, elapsed, matched, len(expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='server to test, e.g. http://127.0.0.1:1200')
+    target.add_argument('--serve', action='store_true',
+                        help='start the server from a fresh database in a temporary directory')
+    parser.add_argument('--server-log', help="the server's stderr, for counting lock errors with --url")
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--concurrency', type=int, default=16, help='customers ordering at once')
+    parser.add_argument('--cashiers', type=int, default=1, help='clients polling /api/check_payments')
+    parser.add_argument('--admins', type=int, default=2, help='open dashboards')
+    parser.add_argument('--poll-interval', type=float, default=3, help='seconds between payment checks')
+    parser.add_argument('--dashboard-interval', type=float, default=2,
+                        help='seconds between dashboard refreshes')
+    parser.add_argument('--unpaid-rate', type=float, default=0.1, help='orders never paid for')
+    parser.add_argument('--typo-rate', type=float, default=0.1,
+                        help='payments with a mistyped reference (matched by name)')
+    parser.add_argument('--noise-rate', type=float, default=0.2,
+                        help='SMS per order that are not for any order')
+    parser.add_argument('--settle', type=float, default=5,
+                        help='seconds to wait for the matcher before counting matches')
+    parser.add_argument('--admin-password', default=ADMIN_PASSWORD)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the report as JSON, for use as a --baseline')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+    args = parser.parse_args()
+
+    if args.serve:
+        with tempfile.TemporaryDirectory() as directory:
+            log_path = os.path.join(directory, 'server.log')
+            with open(log_path, 'wb') as log_file:
+                process, base_url = start_server(directory, log_file)
+                try:
+                    recorder, elapsed, matched, expected = run(args, base_url)
+                finally:
+                    process.terminate()
+                    process.wait()
+            with open(log_path, encoding='utf-8', errors='replace') as log_file:
+                lock_errors = count_lock_errors(log_file.read())
+    else:
+        recorder, elapsed, matched, expected = run(args, args.url.rstrip('/'))
+        lock_errors = None
+        if args.server_log:
+            with open(args.server_log, encoding='utf-8', errors='replace') as log_file:
+                lock_errors = count_lock_errors(log_file.read())
+
+    report = summarize(recorder, elapsed, lock_errors)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['endpoints']
+    print(f"{args.concurrency} customers, {args.cashiers} cashier(s), {args.admins} dashboard(s) "
+          f"for {elapsed:.1f}s")
+    print_report(report, baseline)
+    print(f"payments matched: {matched:,} of {expected:,}"
+          + (f" ({matched / expected:.1%})" if expected else ''))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'elapsed': elapsed, 'matched': matched,
+                       'expected': expected, 'endpoints': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Benchmark fuzzy name lookups over pending orders.
+
+Indexes a set of synthetic customer names the way customers type them
+(first and last name, sometimes misspelt or only a first name) and looks
+up the full registered names M-Pesa reports for the same people.  All
+names go in one index, the worst case where every pending order is for
+the same amount.  Reports lookup latency, how often the right order was
+among the best candidates, and how often the matcher would pay an order
+on the name alone (``confident_match``) and pick the wrong one.
+
+    python benchmarks/name_matching_benchmark.py [--orders 5000] [--lookups 5000] [--seed 1]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from names import NameIndex, confident_match
+
+FIRST_NAMES = ['JOHN', 'MARY', 'PETER', 'DAVID', 'GRACE', 'JANE', 'SAMUEL', 'FAITH',
+               'JAMES', 'ANN', 'JOSEPH', 'ESTHER', 'DANIEL', 'RUTH', 'MOSES', 'LUCY',
+               'BRIAN', 'MERCY', 'KEVIN', 'JOY', 'DENNIS', 'SHARON', 'COLLINS', 'IRENE']
+# Surnames are built from these, giving a few thousand distinct ones
+SYLLABLES = ['KA', 'MA', 'U', 'NJO', 'RO', 'GE', 'WA', 'JI', 'KU', 'O', 'TIE', 'NO',
+             'MU', 'CHI', 'BE', 'TI', 'RI', 'NYA', 'MBU', 'SI', 'KIP', 'TOO', 'A', 'NG']
+
+
+def misspell(rng, name):
+    i = rng.randrange(1, len(name))
+    return name[:i] + name[i + 1:] if rng.random() < 0.5 else name[:i] + name[i] + name[i:]
+
+
+def surname(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def build_people(count, rng):
+    """(registered M-Pesa name, name typed on the order form) pairs"""
+    people = []
+    for _ in range(count):
+        first, middle, last = rng.choice(FIRST_NAMES), surname(rng), surname(rng)
+        registered = f"{first} {middle} {last}"
+        roll = rng.random()
+        if roll < 0.6:
+            typed = f"{first.title()} {middle.title()}"
+        elif roll < 0.9:
+            typed = f"{first.lower()} {misspell(rng, middle).lower()}"
+        else:
+            typed = f"{first.title()} {middle.title()} {last.title()}"
+        people.append((registered, typed))
+    return people
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=5000)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    people = build_people(args.orders, rng)
+    index = NameIndex()
+    start = time.perf_counter()
+    for order_id, (_, typed) in enumerate(people):
+        index.add(order_id, typed)
+    build_time = time.perf_counter() - start
+
+    timings = []
+    found = 0
+    claimed = 0
+    wrong = 0
+    for _ in range(args.lookups):
+        order_id = rng.randrange(len(people))
+        registered, typed = people[order_id]
+        start = time.perf_counter()
+        results = index.search(registered)
+        timings.append(time.perf_counter() - start)
+        # Other orders may score just as well (same typed name); any of the
+        # best-scoring ones counts
+        if any(key == order_id for score, key in results if score == results[0][0]):
+            found += 1
+        claim = confident_match(results)
+        if claim is not None:
+            claimed += 1
+            # Only wrong if it is someone else's name, not the same one typed twice
+            wrong += people[claim][1].lower() != typed.lower()
+
+    timings.sort()
+    print(f"indexed {len(index):,} names in {build_time * 1000:.1f}ms")
+    print(f"lookup   mean {statistics.mean(timings) * 1e6:,.0f}us  "
+          f"p50 {timings[len(timings) // 2] * 1e6:,.0f}us  "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1e6:,.0f}us")
+    print(f"right order among the best candidates: {found / args.lookups:.1%}")
+    print(f"paid on the name alone: {claimed / args.lookups:.1%}, "
+          f"of which someone else's order: {wrong:,}")
+
+
+if __name__ == '__main__':
+    main()
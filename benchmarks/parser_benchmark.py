@@ -0,0 +1,88 @@
+"""Benchmark the shared M-Pesa SMS parser.
+
+Builds a corpus of synthetic messages covering every registered format plus
+non-payment noise, then reports parses/second for the shared parser and for
+the per-call ``re.search`` loop it replaced.
+
+    python benchmarks/parser_benchmark.py [--messages 100000] [--seed 1]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from mpesa_parser import parse_mpesa_sms
+
+FIRST_NAMES = ['JOHN', 'MARY', 'PETER', 'DAVID', 'GRACE', 'JANE', 'SAMUEL', 'FAITH']
+LAST_NAMES = ['KAMAU', 'WANJIKU', 'NJOROGE', 'KIPTOO', 'OTIENO', 'ACHIENG', 'MUTUA']
+
+TEMPLATES = [
+    "Ksh{amount} from {name} on {date} Ref{ref}",
+    "Confirmed. Ksh{amount}.00 paid to RESTAURANT. Ref{ref}",
+    "{name} sent you Ksh{amount}. Reference: {ref}",
+    "Ksh{amount} received from {name} 07{phone} Ref{ref}",
+    # Messages that must be rejected
+    "Your M-PESA balance is Ksh{amount}.00",
+    "Dear customer, your data bundle expires on {date}",
+]
+
+
+def build_corpus(count, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        corpus.append(rng.choice(TEMPLATES).format(
+            amount=f"{rng.randint(10, 20000):,}",
+            name=f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            date=f"{rng.randint(1, 28)}/{rng.randint(1, 12)}/24",
+            ref=f"ORD{rng.randint(0, 999999):06d}",
+            phone=f"{rng.randint(0, 99999999):08d}",
+        ))
+    return corpus
+
+
+def legacy_parse(sms_text):
+    """The parser app.py used before the shared module"""
+    patterns = [
+        r"Ksh([\d,]+)\.?\s*from\s*(.*?)\s*on\s*\d+/\d+/\d+.*?Ref(\w+)",
+        r"Confirmed\.\s*Ksh([\d,]+)\.\d+\s*paid to.*?Ref(\w+)",
+        r"Ksh([\d,]+).*?from\s*(.*?)\s*.*?Ref(\w+)"
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, sms_text, re.IGNORECASE)
+        if match:
+            try:
+                return {
+                    'amount': int(match.group(1).replace(',', '')),
+                    'sender_name': match.group(2).strip().title(),
+                    'reference': match.group(3).strip()
+                }
+            except IndexError:
+                return None
+    return None
+
+
+def run(label, parse, corpus):
+    start = time.perf_counter()
+    parsed = sum(1 for sms in corpus if parse(sms) is not None)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<8} {len(corpus) / elapsed:>12,.0f} parses/s  "
+          f"({parsed:,} of {len(corpus):,} parsed in {elapsed:.3f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages, args.seed)
+    run('shared', parse_mpesa_sms, corpus)
+    run('legacy', legacy_parse, corpus)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark the order reference allocator.
+
+Runs several worker processes, each with several threads, allocating
+references from one fresh database, then checks that no reference was
+handed out twice and reports allocations/second.
+
+    python benchmarks/reference_benchmark.py [--processes 4] [--threads 4]
+        [--allocations 20000] [--block-size 100]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import migrations
+from db import ConnectionPool
+from references import ReferenceAllocator, is_valid_reference
+
+
+def worker(database, threads, allocations, block_size, results):
+    pool = ConnectionPool(database, max_size=threads)
+    allocator = ReferenceAllocator(block_size=block_size)
+    references = []
+
+    def allocate():
+        conn = pool.acquire()
+        try:
+            local = [allocator.allocate(conn) for _ in range(allocations)]
+        finally:
+            pool.release(conn)
+        references.extend(local)
+
+    thread_list = [threading.Thread(target=allocate) for _ in range(threads)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    pool.close_all()
+    results.put(references)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--allocations', type=int, default=20000, help='per thread')
+    parser.add_argument('--block-size', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'orders.db')
+        pool = ConnectionPool(database, max_size=1)
+        conn = pool.acquire()
+        migrations.migrate(conn)
+        pool.release(conn)
+        pool.close_all()
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=worker,
+                                             args=(database, args.threads, args.allocations,
+                                                   args.block_size, results))
+                     for _ in range(args.processes)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        references = []
+        for _ in processes:
+            references.extend(results.get())
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+
+    total = len(references)
+    unique = len(set(references))
+    invalid = sum(1 for reference in references if not is_valid_reference(reference))
+    print(f"{total:,} references from {args.processes} processes x {args.threads} threads "
+          f"in {elapsed:.3f}s: {total / elapsed:,.0f} allocations/s")
+    print(f"duplicates: {total - unique}  invalid: {invalid}  "
+          f"longest: {max(map(len, references))} characters")
+    if total != unique or invalid:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
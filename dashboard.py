@@ -0,0 +1,132 @@
+"""Data for the admin dashboard.
+
+The dashboard page itself is a static shell; its orders, transactions and
+sales figures come from ``/api/dashboard``.  Triggers (see migration 10)
+bump ``app_state.dashboard_version`` whenever an order or transaction is
+created or changes state and stamp the row with the new version, so a
+client that remembers the version of its last refresh only asks for rows
+with a newer one, and an unchanged dashboard costs one primary-key read.
+The same changes feed the live ``/api/events`` stream of every process
+(see ``dashboard_events``).
+"""
+from metrics import timed_query
+from orders import load_order_items
+from stats import sales_summary
+
+ORDER_COLUMNS = ('id', 'customer_name', 'total_amount', 'reference', 'status', 'created_at', 'version')
+TRANSACTION_COLUMNS = ('id', 'sender_name', 'amount', 'reference', 'order_id', 'received_at', 'version')
+# Recent transactions shown on a full refresh
+RECENT_TRANSACTIONS = 10
+
+
+def dashboard_version(conn):
+    return conn.execute("SELECT value FROM app_state WHERE key = 'dashboard_version'").fetchone()[0]
+
+
+def _orders(c, rows):
+    """Order rows as dicts shaped like the order_created / order_paid events"""
+    items = load_order_items(c, [row[0] for row in rows])
+    return [{
+        'order_id': order_id,
+        'customer_name': customer_name,
+        'items': items[order_id],
+        'amount': amount,
+        'reference': reference,
+        'status': status,
+        'created_at': created_at,
+        'version': version
+    } for order_id, customer_name, amount, reference, status, created_at, version in rows]
+
+
+def _transactions(rows):
+    """Transaction rows as dicts shaped like the payment_received event"""
+    return [{
+        'transaction_id': transaction_id,
+        'sender_name': sender_name,
+        'amount': amount,
+        'reference': reference,
+        'order_id': order_id,
+        'received_at': received_at,
+        'version': version
+    } for transaction_id, sender_name, amount, reference, order_id, received_at, version in rows]
+
+
+def dashboard_data(conn, since=None, limit=50, version=None,
+                   transactions=RECENT_TRANSACTIONS, stats=True):
+    """Orders and transactions changed after version since, or a full snapshot.
+
+    A full snapshot (since None, or more than limit changed orders or more
+    than transactions changed transactions) holds the newest limit pending
+    and paid orders and the newest transactions.
+    Rows are oldest first, so a client can apply them in order.
+    """
+    # Read the version before the rows: a row changed in between is sent
+    # again on the next refresh rather than missed
+    if version is None:
+        version = dashboard_version(conn)
+    c = conn.cursor()
+    order_columns = ', '.join(ORDER_COLUMNS)
+    transaction_columns = ', '.join(TRANSACTION_COLUMNS)
+
+    full = since is None or since > version
+    if not full:
+        with timed_query('dashboard.changed_orders') as query:
+            c.execute(f'''SELECT {order_columns} FROM orders WHERE version > ?
+                          ORDER BY version LIMIT ?''', (since, limit + 1))
+            order_rows = c.fetchall()
+            query.rows = len(order_rows)
+        with timed_query('dashboard.changed_transactions') as query:
+            c.execute(f'''SELECT {transaction_columns} FROM transactions WHERE version > ?
+                          ORDER BY version LIMIT ?''', (since, transactions + 1))
+            transaction_rows = c.fetchall()
+            query.rows = len(transaction_rows)
+        # Too much changed to patch the page; send it afresh
+        full = len(order_rows) > limit or len(transaction_rows) > transactions
+    if full:
+        order_rows = []
+        with timed_query('dashboard.recent_orders') as query:
+            for status in ('paid', 'pending'):
+                c.execute(f'''SELECT {order_columns} FROM orders WHERE status = ?
+                              ORDER BY id DESC LIMIT ?''', (status, limit))
+                order_rows.extend(reversed(c.fetchall()))
+            query.rows = len(order_rows)
+        with timed_query('dashboard.recent_transactions') as query:
+            c.execute(f'''SELECT {transaction_columns} FROM transactions
+                          ORDER BY id DESC LIMIT ?''', (transactions,))
+            transaction_rows = c.fetchall()[::-1]
+            query.rows = len(transaction_rows)
+
+    data = {
+        'version': version,
+        'full': full,
+        'orders': _orders(c, order_rows),
+        'transactions': _transactions(transaction_rows)
+    }
+    if stats:
+        data['stats'] = sales_summary(conn)
+    return data
+
+
+def dashboard_events(data):
+    """Server-Sent Events (id, type, data) for a dashboard_data() result, in change order.
+
+    Event ids are dashboard versions, which are the same in every process,
+    so a browser can resume with Last-Event-ID on whichever worker it
+    reconnects to.  Rows changed after data['version'] was read are left
+    for the next call.  A full snapshot means too much changed to replay;
+    browsers are told to reload instead.
+    """
+    version = data['version']
+    if data['full']:
+        return [(version, 'dashboard_stale', {'version': version})]
+    events = []
+    for order in data['orders']:
+        if order['status'] == 'pending':
+            events.append((order['version'], 'order_created', order))
+        elif order['status'] == 'paid':
+            events.append((order['version'], 'order_paid', order))
+        else:
+            events.append((order['version'], 'orders_expired', {'order_ids': [order['order_id']]}))
+    for transaction in data['transactions']:
+        events.append((transaction['version'], 'payment_received', transaction))
+    return sorted((event for event in events if event[0] <= version), key=lambda event: event[0])
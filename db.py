@@ -0,0 +1,123 @@
+"""SQLite data-access layer.
+
+Connections are expensive to open and the default rollback journal makes
+readers and the writer block each other, so the app keeps a small, bounded
+pool of pre-configured connections and hands one to each request through
+the Flask app context.
+"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, g
+
+DATABASE = 'orders.db'
+POOL_SIZE = 8
+POOL_TIMEOUT = 10  # seconds to wait for a free connection
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+# Stay well below SQLite's host-parameter limit for IN (...) lists
+MAX_VARIABLES = 500
+
+
+def chunks(seq, size=MAX_VARIABLES):
+    """Consecutive slices of seq, each small enough to bind as an IN (...) list"""
+    for start in range(0, len(seq), size):
+        yield seq[start:start + size]
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of SQLite connections"""
+
+    def __init__(self, database=DATABASE, max_size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 busy_timeout_ms=BUSY_TIMEOUT_MS, statement_cache_size=STATEMENT_CACHE_SIZE):
+        self.database = database
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.statement_cache_size = statement_cache_size
+        # Most recently used connections are handed out first, so a quiet
+        # period only keeps a few of them warm
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database,
+                               timeout=self.busy_timeout_ms / 1000,
+                               cached_statements=self.statement_cache_size,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        return conn
+
+    def acquire(self):
+        """Take a connection from the pool, opening one if none is idle"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError('timed out waiting for a database connection')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding it if it is broken"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        """Close every idle connection (used on shutdown)"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def get_db():
+    """Return the connection bound to the current app context"""
+    if '_db_conn' not in g:
+        g._db_conn = current_app.extensions['db_pool'].acquire()
+    return g._db_conn
+
+
+def close_db(exception=None):
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        current_app.extensions['db_pool'].release(conn)
+
+
+def init_app(app):
+    """Create the app's connection pool and return connections after each request.
+
+    Calling it again, after the database settings changed, replaces the pool.
+    """
+    pool = app.extensions.get('db_pool')
+    if pool is None:
+        app.teardown_appcontext(close_db)
+    else:
+        pool.close_all()
+    app.extensions['db_pool'] = ConnectionPool(
+        app.config.get('DATABASE', DATABASE),
+        max_size=app.config.get('DB_POOL_SIZE', POOL_SIZE),
+        timeout=app.config.get('DB_POOL_TIMEOUT', POOL_TIMEOUT),
+    )
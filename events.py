@@ -0,0 +1,197 @@
+"""Publish/subscribe for Server-Sent Events.
+
+Each open ``/api/events`` stream holds a subscriber queue on its process's
+``EventBroker``, so an idle dashboard costs one parked thread.  Changes can
+be made by any worker process, so events are not published by the route
+that made the change: every process runs an ``EventRelay`` that reads what
+changed in the database since its last look and publishes it locally.
+A route that commits a change only wakes its own relay, so its own
+subscribers hear about it straight away and the others within
+``RELAY_INTERVAL``.
+
+The relay also wakes the requests parked in ``OrderWaiters`` (the order
+page's long-poll for its payment) when their order changes.
+"""
+import json
+import queue
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+KEEPALIVE_SECONDS = 15
+# Seconds between relay polls; a poll with no change is one primary-key read
+RELAY_INTERVAL = 0.5
+
+
+class Subscriber:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        # Set when the client fell too far behind; its stream is closed and
+        # the browser reconnects with Last-Event-ID to catch up
+        self.overflowed = False
+
+    def get(self, timeout=KEEPALIVE_SECONDS):
+        """Return the next event, or None if nothing arrived within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBroker:
+    """Fans published events out to every subscribed stream"""
+
+    def __init__(self, history=200, queue_size=500):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        # Recent events, replayed to clients reconnecting with Last-Event-ID
+        self._history = deque(maxlen=history)
+        self._queue_size = queue_size
+        self._last_id = 0
+
+    def publish(self, event_type, data, event_id=None):
+        """Send an event to every subscriber; ids must increase (default: the next one)"""
+        with self._lock:
+            self._last_id = self._last_id + 1 if event_id is None else event_id
+            event = (self._last_id, event_type, json.dumps(data))
+            self._history.append(event)
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber.queue.put_nowait(event)
+                except queue.Full:
+                    subscriber.overflowed = True
+                    self._subscribers.discard(subscriber)
+
+    def subscribe(self, last_event_id=None):
+        subscriber = Subscriber(self._queue_size)
+        with self._lock:
+            if last_event_id is not None:
+                for event in self._history:
+                    if event[0] > last_event_id:
+                        subscriber.queue.put_nowait(event)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+
+class OrderWaiters:
+    """Requests waiting for an order's status to change, by order id"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._count = 0
+
+    @contextmanager
+    def waiting(self, order_id, limit=None):
+        """Register before reading the status; the yielded Event is set when the order may have changed.
+
+        Yields None instead when limit requests are already waiting.
+        """
+        changed = threading.Event()
+        with self._lock:
+            if limit is not None and self._count >= limit:
+                changed = None
+            else:
+                self._waiters.setdefault(order_id, set()).add(changed)
+                self._count += 1
+        if changed is None:
+            yield None
+            return
+        try:
+            yield changed
+        finally:
+            with self._lock:
+                self._count -= 1
+                waiters = self._waiters[order_id]
+                waiters.discard(changed)
+                if not waiters:
+                    del self._waiters[order_id]
+
+    def notify(self, order_ids=None):
+        """Wake the requests waiting on order_ids, or all of them"""
+        with self._lock:
+            if order_ids is None:
+                woken = [changed for waiters in self._waiters.values() for changed in waiters]
+            else:
+                woken = [changed for order_id in order_ids for changed in self._waiters.get(order_id, ())]
+        for changed in woken:
+            changed.set()
+
+    def notify_events(self, events):
+        """Wake the requests waiting on orders named in dashboard events"""
+        order_ids = set()
+        for _, event_type, data in events:
+            if event_type == 'dashboard_stale':
+                # Which orders changed is unknown; everyone rechecks
+                self.notify()
+                return
+            if event_type == 'orders_expired':
+                order_ids.update(data['order_ids'])
+            elif 'order_id' in data and data['order_id'] is not None:
+                order_ids.add(data['order_id'])
+        if order_ids:
+            self.notify(order_ids)
+
+    def has_waiters(self):
+        return bool(self._waiters)
+
+
+class EventRelay(threading.Thread):
+    """Publishes changes committed by any process to this process's broker.
+
+    changes(since) is called in an app context and returns (version,
+    events): the current change version and the (event_id, event_type,
+    data) events for changes after since, or none when since is None.
+    Nobody is listening while the broker has no subscribers and waiters
+    (an OrderWaiters) has no requests, so then only the version is followed.
+    """
+
+    def __init__(self, app, broker, changes, interval=RELAY_INTERVAL, waiters=None):
+        super().__init__(daemon=True, name='event-relay')
+        self.app = app
+        self.broker = broker
+        self.changes = changes
+        self.interval = interval
+        self.waiters = waiters
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def notify(self):
+        """Poll now instead of at the next interval (after committing a change)"""
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        since = None
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                listening = self.broker.has_subscribers() or (
+                    self.waiters is not None and self.waiters.has_waiters())
+                with self.app.app_context():
+                    since, events = self.changes(since if listening else None)
+                for event in events:
+                    self.broker.publish(event[1], event[2], event[0])
+                if self.waiters is not None and events:
+                    self.waiters.notify_events(events)
+            except Exception:
+                self.app.logger.exception('Event relay poll failed')
+                self._stopping.wait(self.interval * 10)
+
+
+def format_sse(event):
+    event_id, event_type, data = event
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
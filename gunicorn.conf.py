@@ -0,0 +1,50 @@
+"""gunicorn settings: ``gunicorn -c gunicorn.conf.py``
+
+Settings from app.config can be given as FLASK_<NAME> environment
+variables, e.g. FLASK_DATABASE=/srv/orders/orders.db.
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+
+wsgi_app = 'wsgi:application'
+bind = os.environ.get('BIND', '0.0.0.0:1200')
+
+# SQLite takes one writer at a time, so more processes mostly add lock
+# waits; a few keep reads and page rendering off a single GIL
+workers = int(os.environ.get('WEB_CONCURRENCY', min(4, multiprocessing.cpu_count())))
+# Every open /api/events stream and every order page waiting on
+# /api/orders/<id>/status holds a thread while parked, so workers are
+# threaded rather than one request at a time, with plenty of threads.
+# FLASK_ORDER_STATUS_MAX_WAITERS caps the parked order pages per worker
+# (16 by default) so threads stay free for orders and SMS; raise THREADS
+# and the cap together to hold more phones open at once
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 32))
+# Migrate once in the master, then fork
+preload_app = True
+# SSE streams stay open; the keep-alive comments keep them from timing out
+timeout = 60
+graceful_timeout = 10
+
+# Each worker writes its metrics here so /metrics can add them up
+metrics_dir = os.environ.setdefault('FLASK_METRICS_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'payment-system-metrics'))
+
+
+def on_starting(server):
+    """Forget the metrics of a previous run"""
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    """Keep an exited worker's counts in the exited-workers total.
+
+    Runs in the master once the worker is gone, after its last snapshot
+    was written at exit.
+    """
+    import metrics
+    metrics.fold_snapshot(metrics_dir, worker.pid)
@@ -0,0 +1,277 @@
+"""Transaction ingestion.
+
+Stores parsed M-Pesa SMS and applies each payment to the pending order
+whose reference and amount it carries.  A whole batch is written in one
+transaction: one set-based reference lookup, one ``executemany`` for the
+order updates and one for the inserts.
+
+Requests do not each write their own batch: they hand their entries to the
+process's ``TransactionWriter``, which records everything that arrived
+within a few milliseconds in one transaction (group commit) and then wakes
+the requests.  SQLite has a single writer, so many small concurrent
+writes otherwise queue up on its lock one commit at a time.  A request that
+times out withdraws its entries if the writer has not taken them yet, and
+otherwise waits for the write already under way, so a timeout never leaves
+entries that were committed behind a failed request.
+"""
+import queue
+import sqlite3
+import threading
+import time
+
+from db import chunks
+from metrics import INGEST_GROUP_SIZE, timed_query
+
+# Seconds the writer waits for more entries after the first one arrives
+GROUP_COMMIT_DELAY = 0.002
+# Most entries written in one group; a bigger submission is written alone
+MAX_GROUP_SIZE = 2000
+# Seconds a request waits for the writer to take its entries
+SUBMIT_TIMEOUT = 30
+
+
+def _stored_messages(c, message_ids):
+    """{message_id: (transaction_id, received_at, order_id)} for messages already stored"""
+    stored = {}
+    message_ids = list(message_ids)
+    with timed_query('ingest.stored_messages') as query:
+        for chunk in chunks(message_ids):
+            c.execute(f'''SELECT message_id, id, received_at, order_id FROM transactions
+                          WHERE message_id IN ({', '.join(['?'] * len(chunk))})''', chunk)
+            for message_id, transaction_id, received_at, order_id in c.fetchall():
+                stored[message_id] = (transaction_id, received_at, order_id)
+        query.rows = len(stored)
+    return stored
+
+
+def record_transactions(conn, entries):
+    """Store parsed SMS and mark the orders they pay by reference as paid.
+
+    Expired orders are still accepted: the customer paid late, but paid.
+
+    entries is a list of (sms_text, MpesaTransaction, message_id), where
+    message_id is the forwarder's id for the SMS or None.  A message whose
+    id is already stored (a resend after a lost response) is not stored or
+    applied again.  Returns one dict per entry, in order, with the
+    ``transaction_id``, its ``received_at``, the ``order`` it paid as (id,
+    customer_name, total_amount, reference) or None when the reference
+    matched no unpaid order, and ``duplicate``; for a duplicate the first
+    two describe the stored copy and ``order`` is None.
+    """
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        stored = _stored_messages(c, {message_id for _, _, message_id in entries if message_id})
+        # Positions of the entries to store, and of the first entry of this
+        # batch with each message id
+        fresh = []
+        first_position = {}
+        for position, (sms_text, transaction, message_id) in enumerate(entries):
+            if message_id and (message_id in stored or message_id in first_position):
+                continue
+            fresh.append(position)
+            if message_id:
+                first_position[message_id] = position
+
+        pending = {}
+        references = list({entries[position][1].reference for position in fresh})
+        with timed_query('ingest.orders_by_reference') as query:
+            for chunk in chunks(references):
+                c.execute(f'''SELECT id, customer_name, total_amount, reference FROM orders
+                              WHERE status IN ('pending', 'expired') AND reference IN ({', '.join(['?'] * len(chunk))})''',
+                          chunk)
+                for order in c.fetchall():
+                    pending[order[3]] = order
+            query.rows = len(pending)
+
+        matched = []
+        rows = []
+        for position in fresh:
+            sms_text, transaction, message_id = entries[position]
+            order = pending.get(transaction.reference)
+            if order is not None and order[2] == transaction.amount:
+                # An order can only be paid once, even if the batch repeats it
+                del pending[transaction.reference]
+            else:
+                order = None
+            matched.append(order)
+            rows.append((transaction.sender_name, transaction.amount, transaction.reference,
+                         order[0] if order else None, sms_text, message_id))
+
+        with timed_query('ingest.pay_orders') as query:
+            c.executemany('''UPDATE orders SET status = 'paid'
+                             WHERE id = ? AND status IN ('pending', 'expired')''',
+                          [(order[0],) for order in matched if order])
+            query.rows = c.rowcount
+
+        # We hold the write lock, so the new rows take the next ids in order
+        c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'transactions'")
+        row = c.fetchone()
+        last_id = row[0] if row else 0
+        with timed_query('ingest.insert_transactions') as query:
+            # Duplicates were left out above; OR IGNORE is the backstop
+            c.executemany('''INSERT OR IGNORE INTO transactions
+                             (sender_name, amount, reference, order_id, sms_text, message_id)
+                             VALUES (?, ?, ?, ?, ?, ?)''', rows)
+            c.execute('SELECT id, received_at FROM transactions WHERE id > ? ORDER BY id', (last_id,))
+            inserted = c.fetchall()
+            query.rows = len(inserted)
+        if len(inserted) != len(rows):
+            raise sqlite3.IntegrityError('duplicate message ids in one batch were not detected')
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    results = [None] * len(entries)
+    for position, (transaction_id, received_at), order in zip(fresh, inserted, matched):
+        results[position] = {'transaction_id': transaction_id, 'received_at': received_at,
+                             'order': order, 'duplicate': False}
+    for position, (_, _, message_id) in enumerate(entries):
+        if results[position] is None:
+            if message_id in stored:
+                transaction_id, received_at, _ = stored[message_id]
+            else:
+                first = results[first_position[message_id]]
+                transaction_id, received_at = first['transaction_id'], first['received_at']
+            results[position] = {'transaction_id': transaction_id, 'received_at': received_at,
+                                 'order': None, 'duplicate': True}
+    return results
+
+
+class _Submission:
+    __slots__ = ('entries', 'results', 'error', 'done', 'claimed', 'withdrawn')
+
+    def __init__(self, entries):
+        self.entries = entries
+        # Set under TransactionWriter._claim_lock: by the writer when it
+        # starts writing the entries, or by submit() when it gives up first
+        self.claimed = False
+        self.withdrawn = False
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+# Queued by stop(): write what is already queued, then exit
+_STOP = object()
+
+
+class TransactionWriter(threading.Thread):
+    """Writes submitted entries with record_transactions, many requests per commit.
+
+    submit() blocks until the entries are committed and returns their
+    results, exactly as record_transactions(conn, entries) would.  If the
+    writer has not taken them within timeout seconds they are withdrawn and
+    submit() raises sqlite3.OperationalError without anything written.
+    """
+
+    def __init__(self, app, delay=GROUP_COMMIT_DELAY, max_group_size=MAX_GROUP_SIZE):
+        super().__init__(daemon=True, name='transaction-writer')
+        self.pool = app.extensions['db_pool']
+        self.delay = delay
+        self.max_group_size = max_group_size
+        self._queue = queue.Queue()
+        # Taken off the queue but left for the next group
+        self._held = None
+        self._claim_lock = threading.Lock()
+
+    def submit(self, entries, timeout=SUBMIT_TIMEOUT):
+        if not entries:
+            return []
+        if not self.is_alive():
+            # Stopped (at exit) or never started: write directly
+            with self.pool.connection() as conn:
+                return record_transactions(conn, entries)
+        submission = _Submission(entries)
+        self._queue.put(submission)
+        if not submission.done.wait(timeout):
+            with self._claim_lock:
+                submission.withdrawn = not submission.claimed
+            if submission.withdrawn:
+                raise sqlite3.OperationalError('timed out waiting for the transaction writer')
+            # Already being written; the write itself is bounded by the
+            # pool and busy timeouts
+            submission.done.wait()
+        if submission.error is not None:
+            raise submission.error
+        return submission.results
+
+    def stop(self, timeout=None):
+        self._queue.put(_STOP)
+        if self.is_alive():
+            self.join(timeout)
+
+    def _next(self, stopping, timeout=None):
+        if self._held is not None:
+            submission, self._held = self._held, None
+            return submission
+        if stopping:
+            return self._queue.get_nowait()
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self, first, stopping):
+        """first plus whatever else arrives within delay, up to max_group_size entries"""
+        group = [first]
+        size = len(first.entries)
+        deadline = time.monotonic() + self.delay
+        while size < self.max_group_size:
+            try:
+                submission = self._next(stopping, max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if submission is _STOP or size + len(submission.entries) > self.max_group_size:
+                self._held = submission
+                break
+            group.append(submission)
+            size += len(submission.entries)
+        return group
+
+    def _claim(self, group):
+        """The submissions of group that were not withdrawn, now owned by the writer"""
+        with self._claim_lock:
+            group = [submission for submission in group if not submission.withdrawn]
+            for submission in group:
+                submission.claimed = True
+        return group
+
+    def _write(self, group):
+        with self.pool.connection() as conn:
+            results = record_transactions(conn, [entry for submission in group
+                                                 for entry in submission.entries])
+        INGEST_GROUP_SIZE.observe(len(results))
+        start = 0
+        for submission in group:
+            submission.results = results[start:start + len(submission.entries)]
+            start += len(submission.entries)
+            submission.done.set()
+
+    def run(self):
+        stopping = False
+        while True:
+            try:
+                first = self._next(stopping)
+            except queue.Empty:
+                return
+            if first is _STOP:
+                stopping = True
+                continue
+            group = self._claim(self._collect(first, stopping))
+            if not group:
+                continue
+            try:
+                self._write(group)
+            except Exception as e:
+                if len(group) == 1:
+                    group[0].error = e
+                    group[0].done.set()
+                    continue
+                # Write the submissions one by one, so one that cannot be
+                # written does not fail the others with it
+                for submission in group:
+                    try:
+                        self._write([submission])
+                    except Exception as e:
+                        submission.error = e
+                        submission.done.set()
@@ -0,0 +1,211 @@
+"""Incremental payment matcher.
+
+Instead of comparing every transaction ever received against every pending
+order on each poll, the matcher remembers the last transaction id it has
+examined (persisted in the ``matcher_state`` table so every process shares
+it) and keeps pending orders in a hash index on reference and, per amount,
+a fuzzy index of customer names (see ``names``).  A name match only pays
+an order when it is unambiguous (``names.confident_match``).
+
+The indexes follow the orders table through the dashboard version (see
+migration 10): each poll reads the orders stamped with a newer version,
+adding new pending orders and dropping any that were paid or expired,
+whichever process or path did it.  A poll therefore only costs time
+proportional to what changed since the previous one.
+"""
+import threading
+from collections import defaultdict, deque
+
+from dashboard import dashboard_version
+from metrics import MATCHER_EXAMINED, MATCHER_MATCHES, timed_query
+from names import NameIndex, confident_match
+from orders import load_order_items
+
+HIGH_WATER_MARK_KEY = 'last_transaction_id'
+
+
+def normalize_reference(reference):
+    """References are typed by hand into M-Pesa, so compare them case-insensitively"""
+    return (reference or '').strip().upper()
+
+
+class PaymentMatcher:
+    """Matches new M-Pesa transactions to pending orders through in-memory indexes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Dashboard version the indexes are up to date with; None to rebuild
+        self._version = None
+        # order_id -> (customer_name, total_amount, reference)
+        self._orders = {}
+        # amount -> fuzzy index of the customer names of orders for that amount
+        self._names_by_amount = defaultdict(NameIndex)
+        self._by_reference = defaultdict(deque)
+
+    def _index_order(self, order_id, customer_name, amount, reference):
+        self._orders[order_id] = (customer_name, amount, reference)
+        self._names_by_amount[amount].add(order_id, customer_name)
+        if reference:
+            self._by_reference[normalize_reference(reference)].append(order_id)
+
+    def _drop_order(self, order_id):
+        customer_name, amount, reference = self._orders.pop(order_id)
+        names = self._names_by_amount.get(amount)
+        if names is not None:
+            names.remove(order_id)
+            if not names:
+                del self._names_by_amount[amount]
+        bucket = self._by_reference.get(normalize_reference(reference))
+        if bucket is not None:
+            try:
+                bucket.remove(order_id)
+            except ValueError:
+                pass
+            if not bucket:
+                del self._by_reference[normalize_reference(reference)]
+
+    def _sync_orders(self, conn):
+        """Bring the indexes up to date with orders created, paid or expired since the last poll"""
+        version = dashboard_version(conn)
+        if version == self._version:
+            return
+        c = conn.cursor()
+        if self._version is None:
+            self._reset()
+            with timed_query('matcher.pending_orders') as query:
+                c.execute('''SELECT id, customer_name, total_amount, reference
+                             FROM orders WHERE status = 'pending' ORDER BY id''')
+                orders = c.fetchall()
+                query.rows = len(orders)
+            for order in orders:
+                self._index_order(*order)
+        else:
+            with timed_query('matcher.changed_orders') as query:
+                c.execute('''SELECT id, customer_name, total_amount, reference, status
+                             FROM orders WHERE version > ? ORDER BY version''', (self._version,))
+                orders = c.fetchall()
+                query.rows = len(orders)
+            for order_id, customer_name, amount, reference, status in orders:
+                if status == 'pending':
+                    if order_id not in self._orders:
+                        self._index_order(order_id, customer_name, amount, reference)
+                elif order_id in self._orders:
+                    self._drop_order(order_id)
+        self._version = version
+
+    def _candidates(self, sender_name, amount, reference):
+        """Return candidate order ids for the same amount.
+
+        Reference matches come first (oldest first), then the order whose
+        customer name matches the payer's, if exactly one clearly does.
+        """
+        candidates = [order_id for order_id in self._by_reference.get(normalize_reference(reference), ())
+                      if self._orders[order_id][1] == amount]
+        names = self._names_by_amount.get(amount)
+        if names is not None and sender_name:
+            order_id = confident_match(names.search(sender_name))
+            if order_id is not None and order_id not in candidates:
+                candidates.append(order_id)
+        return candidates
+
+    def _high_water_mark(self, c):
+        c.execute('SELECT value FROM matcher_state WHERE key = ?', (HIGH_WATER_MARK_KEY,))
+        row = c.fetchone()
+        return row[0] if row else 0
+
+    def backlog(self, conn):
+        """Number of transactions the matcher has not examined yet (no write lock needed)"""
+        c = conn.cursor()
+        with timed_query('matcher.backlog'):
+            c.execute('SELECT COUNT(*) FROM transactions WHERE id > ?', (self._high_water_mark(c),))
+            return c.fetchone()[0]
+
+    def poll(self, conn, limit=None):
+        """Match transactions received since the last poll, at most limit of them.
+
+        Each payment is applied at most once: an order is claimed with a
+        conditional UPDATE that only succeeds while it is still pending and
+        the transaction is linked to it through transactions.order_id, both
+        inside one write transaction together with the high-water mark.
+        Returns a list of dicts describing the orders that were paid.
+        """
+        matched_orders = []
+        # What matched each paid order, counted once the poll has committed
+        matched_by = []
+        with self._lock:
+            c = conn.cursor()
+            # Dashboards poll often and usually find nothing; don't queue
+            # behind other writers just to learn that
+            if not self.backlog(conn):
+                return matched_orders
+
+            # Take the write lock up front so two processes never examine the
+            # same batch of transactions
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                self._sync_orders(conn)
+
+                # Another process may have moved the mark while we waited
+                last_transaction_id = self._high_water_mark(c)
+
+                with timed_query('matcher.new_transactions') as query:
+                    c.execute('''SELECT id, sender_name, amount, reference, order_id FROM transactions
+                                 WHERE id > ? ORDER BY id LIMIT ?''',
+                              (last_transaction_id, -1 if limit is None else limit))
+                    new_transactions = c.fetchall()
+                    query.rows = len(new_transactions)
+
+                for transaction_id, sender_name, amount, reference, linked_order in new_transactions:
+                    last_transaction_id = transaction_id
+                    if linked_order is not None:
+                        # Already applied to an order by its reference on arrival
+                        continue
+                    for order_id in self._candidates(sender_name, amount, reference):
+                        # The order may have been paid through another path since
+                        # it was indexed, so only claim it if it is still pending
+                        with timed_query('matcher.claim_order') as query:
+                            c.execute('''UPDATE orders SET status = 'paid'
+                                         WHERE id = ? AND status = 'pending' ''', (order_id,))
+                            query.rows = c.rowcount
+                        claimed = c.rowcount == 1
+                        customer_name, order_amount, order_reference = self._orders[order_id]
+                        self._drop_order(order_id)
+                        if not claimed:
+                            continue
+
+                        c.execute('''UPDATE transactions SET order_id = ?
+                                     WHERE id = ? AND order_id IS NULL''', (order_id, transaction_id))
+                        matched_by.append('reference' if normalize_reference(reference)
+                                          == normalize_reference(order_reference) else 'name')
+                        matched_orders.append({
+                            'order_id': order_id,
+                            'transaction_id': transaction_id,
+                            'customer_name': customer_name,
+                            'amount': order_amount,
+                            'reference': order_reference
+                        })
+                        break  # Move to next transaction after finding a match
+
+                # One query for the items of every order paid in this poll
+                items = load_order_items(c, [order['order_id'] for order in matched_orders])
+                for order in matched_orders:
+                    order['items'] = items[order['order_id']]
+
+                c.execute('''INSERT OR REPLACE INTO matcher_state (key, value) VALUES (?, ?)''',
+                          (HIGH_WATER_MARK_KEY, last_transaction_id))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                # The indexes may no longer agree with the database; rebuild
+                # them from scratch on the next poll
+                self._reset()
+                raise
+
+            MATCHER_EXAMINED.inc(amount=len(new_transactions))
+            for by in matched_by:
+                MATCHER_MATCHES.inc(by)
+
+        return matched_orders
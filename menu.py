@@ -0,0 +1,87 @@
+"""Menu stored in the ``menu_items`` table.
+
+Triggers bump ``app_state.menu_version`` on every change to the menu, so
+each process keeps the menu (and its rendered page) in memory and only has
+to compare one integer, read by primary key, to know whether it is stale.
+"""
+import threading
+
+MENU_FIELDS = ('id', 'name', 'price', 'category', 'available')
+
+
+def menu_version(conn):
+    return conn.execute("SELECT value FROM app_state WHERE key = 'menu_version'").fetchone()[0]
+
+
+class Menu:
+    """One version of the menu"""
+
+    def __init__(self, version, items):
+        self.version = version
+        # Every item, including unavailable ones (for the admin API)
+        self.all_items = items
+        # What customers can order
+        self.items = [item for item in items if item['available']]
+        self.by_id = {item['id']: item for item in self.items}
+        # Rendered menu page (a page_cache.CachedPage), built on first request
+        self.page = None
+
+
+class MenuCache:
+    """Per-process cache of the current Menu"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._menu = None
+
+    def current(self, conn):
+        version = menu_version(conn)
+        menu = self._menu
+        if menu is not None and menu.version == version:
+            return menu
+
+        with self._lock:
+            if self._menu is not None and self._menu.version == version:
+                return self._menu
+            rows = conn.execute('''SELECT id, name, price, category, available
+                                   FROM menu_items ORDER BY id''').fetchall()
+            items = [dict(zip(MENU_FIELDS, row)) for row in rows]
+            for item in items:
+                item['available'] = bool(item['available'])
+            self._menu = Menu(version, items)
+            return self._menu
+
+
+def parse_menu_item(data, partial=False):
+    """Validate a menu item from the admin API.
+
+    Returns (fields, error); with partial=True only the fields present in
+    data are required to be valid.
+    """
+    if not isinstance(data, dict):
+        return None, 'Expected a JSON object'
+
+    fields = {}
+    if 'name' in data or not partial:
+        name = data.get('name')
+        if not isinstance(name, str) or not name.strip():
+            return None, 'name must be a non-empty string'
+        fields['name'] = name.strip()
+    if 'price' in data or not partial:
+        price = data.get('price')
+        if isinstance(price, bool) or not isinstance(price, int) or price < 0:
+            return None, 'price must be a non-negative integer'
+        fields['price'] = price
+    if 'category' in data or not partial:
+        category = data.get('category', '')
+        if not isinstance(category, str):
+            return None, 'category must be a string'
+        fields['category'] = category.strip()
+    if 'available' in data:
+        if not isinstance(data['available'], bool):
+            return None, 'available must be true or false'
+        fields['available'] = int(data['available'])
+
+    if not fields:
+        return None, 'Nothing to update'
+    return fields, None
@@ -0,0 +1,330 @@
+"""In-process metrics, exposed in the Prometheus text format.
+
+Counters, gauges and histograms are kept in plain dictionaries keyed by
+label values, each behind its own lock; histograms have fixed buckets, so
+recording a request or a query costs a bisect and a few additions.  Every
+process keeps its own numbers.  When several worker processes serve the
+app, each one also writes them to a file in a shared directory every few
+seconds (``SnapshotWriter``) and /metrics adds up the files of every
+process, so a scrape sees the totals whichever worker answers it.  When a
+worker exits, the gunicorn master folds its file into one for all exited
+workers (``fold_snapshot``), so totals never drop and a new worker that
+reuses the pid starts a file of its own.
+
+Queries are timed by name rather than by SQL text::
+
+    with timed_query('matcher.new_transactions') as query:
+        c.execute(...)
+        rows = c.fetchall()
+        query.rows = len(rows)
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+from flask import g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SNAPSHOT_INTERVAL = 5
+# Written only by the gunicorn master, from the files of exited workers
+EXITED_SNAPSHOT = 'exited.json'
+# Seconds; requests and queries on this app take from well under a
+# millisecond to a few seconds when the database is busy
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def snapshot(self):
+        """This process's counters and histograms, as JSON-friendly lists"""
+        return {metric.name: [[list(key), value] for key, value in metric.values().items()]
+                for metric in self._metrics if metric.kind != 'gauge'}
+
+    def combine(self, snapshots):
+        """Snapshots taken in several processes, added up into one"""
+        combined = {}
+        for metric in self._metrics:
+            if metric.kind == 'gauge':
+                continue
+            values = {}
+            for snapshot in snapshots:
+                for key, value in snapshot.get(metric.name, ()):
+                    metric.add(values, tuple(key), value)
+            combined[metric.name] = [[list(key), value] for key, value in values.items()]
+        return combined
+
+    def render(self, snapshots=()):
+        """The text exposition, adding in snapshots taken in other processes"""
+        lines = []
+        for metric in self._metrics:
+            values = metric.values()
+            if metric.kind != 'gauge':
+                for snapshot in snapshots:
+                    for key, value in snapshot.get(metric.name, ()):
+                        metric.add(values, tuple(key), value)
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples(values))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.register(self)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def add(values, key, value):
+        values[key] = values.get(key, 0) + value
+
+    def samples(self, values):
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+                for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down; set() it or give it a function read at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def set_function(self, function):
+        """function() returns the value (for a gauge without labels)"""
+        self._function = function
+
+    def values(self):
+        if self._function is not None:
+            self.set(self._function())
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self, values):
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def values(self):
+        with self._lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self._values.items()}
+
+    @staticmethod
+    def add(values, key, value):
+        series = values.get(key)
+        if series is None:
+            values[key] = [list(value[0]), value[1], value[2]]
+        else:
+            series[0] = [a + b for a, b in zip(series[0], value[0])]
+            series[1] += value[1]
+            series[2] += value[2]
+
+    def samples(self, values):
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds',
+                             'Time spent handling HTTP requests, by Flask endpoint.',
+                             ('endpoint', 'method', 'status'))
+QUERY_DURATION = Histogram('sqlite_query_duration_seconds',
+                           'Time spent running named SQLite queries.', ('query',))
+QUERY_ROWS = Counter('sqlite_query_rows_total',
+                     'Rows returned or changed by named SQLite queries.', ('query',))
+QUERY_ERRORS = Counter('sqlite_query_errors_total',
+                       'Named SQLite queries that raised, e.g. "database is locked".', ('query',))
+MATCHER_EXAMINED = Counter('matcher_transactions_examined_total',
+                           'Transactions examined by the payment matcher.')
+MATCHER_MATCHES = Counter('matcher_matches_total',
+                          'Orders paid by the payment matcher, by what matched.', ('by',))
+MATCHER_BACKLOG = Gauge('matcher_backlog_transactions',
+                        'Transactions the payment matcher has not examined yet.')
+INGEST_GROUP_SIZE = Histogram('ingest_group_commit_transactions',
+                              'Transactions written per group commit by the transaction writer.',
+                              buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000))
+
+
+class QueryTimer:
+    __slots__ = ('name', 'rows', '_start')
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        QUERY_DURATION.observe(time.perf_counter() - self._start, self.name)
+        if self.rows:
+            QUERY_ROWS.inc(self.name, amount=self.rows)
+        if exc_type is not None:
+            QUERY_ERRORS.inc(self.name)
+        return False
+
+
+def timed_query(name):
+    """Time the statements run inside the with block as query name; set .rows on the result"""
+    return QueryTimer(name)
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def write_snapshot(directory):
+    """Leave this process's metrics in directory for the other processes' scrapes"""
+    _write_json(os.path.join(directory, f'{os.getpid()}.json'), REGISTRY.snapshot())
+
+
+def fold_snapshot(directory, pid):
+    """Add the last snapshot of exited process pid to EXITED_SNAPSHOT and remove its file"""
+    path = os.path.join(directory, f'{pid}.json')
+    try:
+        with open(path) as f:
+            snapshots = [json.load(f)]
+    except (OSError, ValueError):
+        return  # Exited before its first write
+    exited_path = os.path.join(directory, EXITED_SNAPSHOT)
+    try:
+        with open(exited_path) as f:
+            snapshots.append(json.load(f))
+    except OSError:
+        pass  # The first worker to exit
+    _write_json(exited_path, REGISTRY.combine(snapshots))
+    os.remove(path)
+
+
+def render(directory=None):
+    """The text exposition for a scrape: this process, plus every other one writing to directory"""
+    if not directory:
+        return REGISTRY.render()
+    own = f'{os.getpid()}.json'
+    snapshots = []
+    for name in os.listdir(directory):
+        if name.endswith('.json') and name != own:
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Being replaced; its numbers arrive with the next scrape
+    return REGISTRY.render(snapshots)
+
+
+class SnapshotWriter(threading.Thread):
+    """Writes this process's metrics to directory every interval seconds"""
+
+    def __init__(self, directory, interval=SNAPSHOT_INTERVAL):
+        super().__init__(daemon=True, name='metrics-writer')
+        self.directory = directory
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            write_snapshot(self.directory)
+            if self._stopping.wait(self.interval):
+                # One last write so nothing counted since is lost
+                write_snapshot(self.directory)
+                return
+
+
+def _start_timer():
+    g._request_start = time.perf_counter()
+
+
+def _record_request(response):
+    start = g.pop('_request_start', None)
+    if start is not None:
+        REQUEST_DURATION.observe(time.perf_counter() - start, request.endpoint or 'unmatched',
+                                 request.method, str(response.status_code))
+    return response
+
+
+def init_app(app):
+    """Record the latency of every request the app handles"""
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
@@ -0,0 +1,345 @@
+"""Versioned schema migrations.
+
+The schema version is kept in SQLite's ``PRAGMA user_version``.  Each entry
+in ``MIGRATIONS`` moves the database from version N to N+1 and runs inside
+its own write transaction, so a crash or a second process starting at the
+same time never leaves the schema half-upgraded.
+
+Only ever append to ``MIGRATIONS``; never edit an entry that has shipped.
+"""
+
+MIGRATIONS = [
+    ('create orders, transactions and matcher_state', [
+        '''CREATE TABLE IF NOT EXISTS orders
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_name TEXT,
+            items TEXT,
+            total_amount INTEGER,
+            status TEXT DEFAULT 'pending',
+            reference TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS transactions
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_name TEXT,
+            amount INTEGER,
+            reference TEXT,
+            order_id INTEGER,
+            sms_text TEXT,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS matcher_state
+           (key TEXT PRIMARY KEY,
+            value INTEGER)''',
+    ]),
+    ('index orders and transactions for the dashboard, matcher and reference lookup', [
+        # Older databases can hold repeated references (they used to be
+        # derived from the time of day only). Keep the newest order on each
+        # reference and make the others unique before adding the constraint.
+        '''UPDATE orders SET reference = reference || '-' || id
+           WHERE reference IS NOT NULL
+             AND id NOT IN (SELECT MAX(id) FROM orders
+                            WHERE reference IS NOT NULL GROUP BY reference)''',
+        # add_transaction: WHERE reference = ? AND total_amount = ? AND status = 'pending'
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_reference
+           ON orders (reference)''',
+        # Dashboard: WHERE status = ? ORDER BY created_at DESC
+        '''CREATE INDEX IF NOT EXISTS idx_orders_status_created
+           ON orders (status, created_at)''',
+        # Matcher: pending orders created since its last poll (covering)
+        '''CREATE INDEX IF NOT EXISTS idx_orders_pending
+           ON orders (id, customer_name, total_amount, reference)
+           WHERE status = 'pending' ''',
+        # Dashboard: recent transactions
+        '''CREATE INDEX IF NOT EXISTS idx_transactions_received
+           ON transactions (received_at)''',
+        '''CREATE INDEX IF NOT EXISTS idx_transactions_order
+           ON transactions (order_id)''',
+        # Without statistics the planner prefers idx_orders_status_created
+        # for the matcher query and sorts the whole pending set
+        'ANALYZE',
+    ]),
+    ('index orders for keyset pagination in /api/orders', [
+        # WHERE status = ? AND id < ? ORDER BY id DESC
+        '''CREATE INDEX IF NOT EXISTS idx_orders_status_id
+           ON orders (status, id)''',
+        # since/until date-range exports
+        '''CREATE INDEX IF NOT EXISTS idx_orders_created
+           ON orders (created_at)''',
+    ]),
+    ('move the menu into menu_items with a version counter', [
+        '''CREATE TABLE IF NOT EXISTS menu_items
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            category TEXT,
+            available INTEGER NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        # The menu that used to be hardcoded in app.py
+        '''INSERT OR IGNORE INTO menu_items (id, name, price, category) VALUES
+           (1, 'rice', 1500, 'Main'),
+           (2, 'ndengu', 1000, 'Main'),
+           (3, 'ugali', 40, 'Sides'),
+           (4, 'fulu', 30, 'Main'),
+           (5, 'omena', 30, 'Main'),
+           (6, 'tea', 20, 'Drinks')''',
+        '''CREATE TABLE IF NOT EXISTS app_state
+           (key TEXT PRIMARY KEY,
+            value INTEGER)''',
+        '''INSERT OR IGNORE INTO app_state (key, value) VALUES ('menu_version', 1)''',
+        # Every change to the menu bumps its version, whoever makes it
+        '''CREATE TRIGGER IF NOT EXISTS menu_items_insert_version AFTER INSERT ON menu_items
+           BEGIN UPDATE app_state SET value = value + 1 WHERE key = 'menu_version'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS menu_items_update_version AFTER UPDATE ON menu_items
+           BEGIN UPDATE app_state SET value = value + 1 WHERE key = 'menu_version'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS menu_items_delete_version AFTER DELETE ON menu_items
+           BEGIN UPDATE app_state SET value = value + 1 WHERE key = 'menu_version'; END''',
+    ]),
+    ('add the order reference counter', [
+        # Next unreserved number for references.ReferenceAllocator
+        '''INSERT OR IGNORE INTO app_state (key, value) VALUES ('reference_next', 1)''',
+    ]),
+    ('one paid status and at most one transaction per order', [
+        # The matcher used to mark orders 'completed' and reference matches
+        # 'paid'; the dashboard only ever showed 'paid'
+        '''UPDATE orders SET status = 'paid' WHERE status = 'completed' ''',
+        # Keep only the first transaction linked to each order
+        '''UPDATE transactions SET order_id = NULL
+           WHERE order_id IS NOT NULL
+             AND id > (SELECT MIN(t.id) FROM transactions t WHERE t.order_id = transactions.order_id)''',
+        'DROP INDEX IF EXISTS idx_transactions_order',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_order
+           ON transactions (order_id) WHERE order_id IS NOT NULL''',
+    ]),
+    ('add leases for background workers', [
+        '''CREATE TABLE IF NOT EXISTS worker_leases
+           (name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL)''',
+    ]),
+    ('add sales rollups maintained by triggers', [
+        # Orders are bucketed by the hour/day they were created in, so
+        # conversion (paid / created) is exact for every period
+        '''CREATE TABLE IF NOT EXISTS sales_hourly
+           (hour TEXT PRIMARY KEY,
+            orders_created INTEGER NOT NULL DEFAULT 0,
+            orders_paid INTEGER NOT NULL DEFAULT 0,
+            orders_expired INTEGER NOT NULL DEFAULT 0,
+            revenue_ordered INTEGER NOT NULL DEFAULT 0,
+            revenue_paid INTEGER NOT NULL DEFAULT 0)''',
+        '''CREATE TABLE IF NOT EXISTS sales_daily
+           (day TEXT PRIMARY KEY,
+            orders_created INTEGER NOT NULL DEFAULT 0,
+            orders_paid INTEGER NOT NULL DEFAULT 0,
+            orders_expired INTEGER NOT NULL DEFAULT 0,
+            revenue_ordered INTEGER NOT NULL DEFAULT 0,
+            revenue_paid INTEGER NOT NULL DEFAULT 0)''',
+        '''CREATE TABLE IF NOT EXISTS item_sales_daily
+           (day TEXT,
+            item TEXT,
+            ordered INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, item))''',
+        # Orders that already exist
+        '''INSERT INTO sales_hourly (hour, orders_created, orders_paid, orders_expired,
+                                    revenue_ordered, revenue_paid)
+           SELECT substr(created_at, 1, 13), COUNT(*),
+                  SUM(status = 'paid'), SUM(status = 'expired'),
+                  SUM(total_amount), SUM(CASE WHEN status = 'paid' THEN total_amount ELSE 0 END)
+           FROM orders GROUP BY 1''',
+        '''INSERT INTO sales_daily (day, orders_created, orders_paid, orders_expired,
+                                   revenue_ordered, revenue_paid)
+           SELECT substr(hour, 1, 10), SUM(orders_created), SUM(orders_paid), SUM(orders_expired),
+                  SUM(revenue_ordered), SUM(revenue_paid)
+           FROM sales_hourly GROUP BY 1''',
+        '''INSERT INTO item_sales_daily (day, item, ordered, paid)
+           SELECT substr(orders.created_at, 1, 10), item.value, COUNT(*), SUM(orders.status = 'paid')
+           FROM orders, json_each(orders.items) AS item
+           WHERE json_valid(orders.items) GROUP BY 1, 2''',
+        '''CREATE TRIGGER IF NOT EXISTS orders_sales_insert AFTER INSERT ON orders
+           BEGIN
+               INSERT INTO sales_hourly (hour, orders_created, revenue_ordered)
+               VALUES (substr(NEW.created_at, 1, 13), 1, NEW.total_amount)
+               ON CONFLICT (hour) DO UPDATE SET orders_created = orders_created + 1,
+                                                revenue_ordered = revenue_ordered + excluded.revenue_ordered;
+               INSERT INTO sales_daily (day, orders_created, revenue_ordered)
+               VALUES (substr(NEW.created_at, 1, 10), 1, NEW.total_amount)
+               ON CONFLICT (day) DO UPDATE SET orders_created = orders_created + 1,
+                                               revenue_ordered = revenue_ordered + excluded.revenue_ordered;
+               INSERT INTO item_sales_daily (day, item, ordered)
+               SELECT substr(NEW.created_at, 1, 10), value, COUNT(*) FROM json_each(NEW.items)
+               WHERE json_valid(NEW.items) GROUP BY value
+               ON CONFLICT (day, item) DO UPDATE SET ordered = ordered + excluded.ordered;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS orders_sales_paid AFTER UPDATE OF status ON orders
+           WHEN NEW.status = 'paid' AND OLD.status != 'paid'
+           BEGIN
+               UPDATE sales_hourly SET orders_paid = orders_paid + 1,
+                                       orders_expired = orders_expired - (OLD.status = 'expired'),
+                                       revenue_paid = revenue_paid + NEW.total_amount
+               WHERE hour = substr(NEW.created_at, 1, 13);
+               UPDATE sales_daily SET orders_paid = orders_paid + 1,
+                                      orders_expired = orders_expired - (OLD.status = 'expired'),
+                                      revenue_paid = revenue_paid + NEW.total_amount
+               WHERE day = substr(NEW.created_at, 1, 10);
+               INSERT INTO item_sales_daily (day, item, paid)
+               SELECT substr(NEW.created_at, 1, 10), value, COUNT(*) FROM json_each(NEW.items)
+               WHERE json_valid(NEW.items) GROUP BY value
+               ON CONFLICT (day, item) DO UPDATE SET paid = paid + excluded.paid;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS orders_sales_expired AFTER UPDATE OF status ON orders
+           WHEN NEW.status = 'expired' AND OLD.status = 'pending'
+           BEGIN
+               UPDATE sales_hourly SET orders_expired = orders_expired + 1
+               WHERE hour = substr(NEW.created_at, 1, 13);
+               UPDATE sales_daily SET orders_expired = orders_expired + 1
+               WHERE day = substr(NEW.created_at, 1, 10);
+           END''',
+    ]),
+    ('move order items into order_items with quantities and unit prices', [
+        '''CREATE TABLE IF NOT EXISTS order_items
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            item_id INTEGER,
+            name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            unit_price INTEGER NOT NULL)''',
+        '''CREATE INDEX IF NOT EXISTS idx_order_items_order
+           ON order_items (order_id)''',
+        '''CREATE INDEX IF NOT EXISTS idx_order_items_item
+           ON order_items (item_id)''',
+        # Old orders only kept a JSON list of names; repeats become quantities
+        # and prices come from the current menu
+        '''INSERT INTO order_items (order_id, item_id, name, quantity, unit_price)
+           SELECT orders.id,
+                  (SELECT id FROM menu_items WHERE name = item.value ORDER BY id LIMIT 1),
+                  item.value, COUNT(*),
+                  COALESCE((SELECT price FROM menu_items WHERE name = item.value ORDER BY id LIMIT 1), 0)
+           FROM orders, json_each(orders.items) AS item
+           WHERE json_valid(orders.items)
+           GROUP BY orders.id, item.value
+           ORDER BY orders.id, MIN(item.key)''',
+        'ALTER TABLE item_sales_daily ADD COLUMN revenue_ordered INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE item_sales_daily ADD COLUMN revenue_paid INTEGER NOT NULL DEFAULT 0',
+        '''UPDATE item_sales_daily SET
+               revenue_ordered = (SELECT COALESCE(SUM(oi.quantity * oi.unit_price), 0)
+                                  FROM orders JOIN order_items oi ON oi.order_id = orders.id
+                                  WHERE substr(orders.created_at, 1, 10) = item_sales_daily.day
+                                    AND oi.name = item_sales_daily.item),
+               revenue_paid = (SELECT COALESCE(SUM(oi.quantity * oi.unit_price), 0)
+                               FROM orders JOIN order_items oi ON oi.order_id = orders.id
+                               WHERE substr(orders.created_at, 1, 10) = item_sales_daily.day
+                                 AND oi.name = item_sales_daily.item AND orders.status = 'paid')''',
+        # Item rollups now come from order_items instead of orders.items
+        'DROP TRIGGER IF EXISTS orders_sales_insert',
+        '''CREATE TRIGGER IF NOT EXISTS orders_sales_insert AFTER INSERT ON orders
+           BEGIN
+               INSERT INTO sales_hourly (hour, orders_created, revenue_ordered)
+               VALUES (substr(NEW.created_at, 1, 13), 1, NEW.total_amount)
+               ON CONFLICT (hour) DO UPDATE SET orders_created = orders_created + 1,
+                                                revenue_ordered = revenue_ordered + excluded.revenue_ordered;
+               INSERT INTO sales_daily (day, orders_created, revenue_ordered)
+               VALUES (substr(NEW.created_at, 1, 10), 1, NEW.total_amount)
+               ON CONFLICT (day) DO UPDATE SET orders_created = orders_created + 1,
+                                               revenue_ordered = revenue_ordered + excluded.revenue_ordered;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS order_items_sales_insert AFTER INSERT ON order_items
+           BEGIN
+               INSERT INTO item_sales_daily (day, item, ordered, revenue_ordered)
+               SELECT substr(created_at, 1, 10), NEW.name, NEW.quantity, NEW.quantity * NEW.unit_price
+               FROM orders WHERE id = NEW.order_id
+               ON CONFLICT (day, item) DO UPDATE SET ordered = ordered + excluded.ordered,
+                                                     revenue_ordered = revenue_ordered + excluded.revenue_ordered;
+           END''',
+        'DROP TRIGGER IF EXISTS orders_sales_paid',
+        '''CREATE TRIGGER IF NOT EXISTS orders_sales_paid AFTER UPDATE OF status ON orders
+           WHEN NEW.status = 'paid' AND OLD.status != 'paid'
+           BEGIN
+               UPDATE sales_hourly SET orders_paid = orders_paid + 1,
+                                       orders_expired = orders_expired - (OLD.status = 'expired'),
+                                       revenue_paid = revenue_paid + NEW.total_amount
+               WHERE hour = substr(NEW.created_at, 1, 13);
+               UPDATE sales_daily SET orders_paid = orders_paid + 1,
+                                      orders_expired = orders_expired - (OLD.status = 'expired'),
+                                      revenue_paid = revenue_paid + NEW.total_amount
+               WHERE day = substr(NEW.created_at, 1, 10);
+               INSERT INTO item_sales_daily (day, item, paid, revenue_paid)
+               SELECT substr(NEW.created_at, 1, 10), name, SUM(quantity), SUM(quantity * unit_price)
+               FROM order_items WHERE order_id = NEW.id GROUP BY name
+               ON CONFLICT (day, item) DO UPDATE SET paid = paid + excluded.paid,
+                                                     revenue_paid = revenue_paid + excluded.revenue_paid;
+           END''',
+    ]),
+    ('version orders and transactions for incremental dashboard refreshes', [
+        # Every change the dashboard shows bumps dashboard_version and stamps
+        # the changed row with it, whoever makes the change
+        '''INSERT OR IGNORE INTO app_state (key, value) VALUES ('dashboard_version', 1)''',
+        'ALTER TABLE orders ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE transactions ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+        '''CREATE INDEX IF NOT EXISTS idx_orders_version
+           ON orders (version)''',
+        '''CREATE INDEX IF NOT EXISTS idx_transactions_version
+           ON transactions (version)''',
+        '''CREATE TRIGGER IF NOT EXISTS orders_dashboard_insert AFTER INSERT ON orders
+           BEGIN
+               UPDATE app_state SET value = value + 1 WHERE key = 'dashboard_version';
+               UPDATE orders SET version = (SELECT value FROM app_state WHERE key = 'dashboard_version')
+               WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS orders_dashboard_status AFTER UPDATE OF status ON orders
+           WHEN NEW.status != OLD.status
+           BEGIN
+               UPDATE app_state SET value = value + 1 WHERE key = 'dashboard_version';
+               UPDATE orders SET version = (SELECT value FROM app_state WHERE key = 'dashboard_version')
+               WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS transactions_dashboard_insert AFTER INSERT ON transactions
+           BEGIN
+               UPDATE app_state SET value = value + 1 WHERE key = 'dashboard_version';
+               UPDATE transactions SET version = (SELECT value FROM app_state WHERE key = 'dashboard_version')
+               WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS transactions_dashboard_order AFTER UPDATE OF order_id ON transactions
+           WHEN NEW.order_id IS NOT OLD.order_id
+           BEGIN
+               UPDATE app_state SET value = value + 1 WHERE key = 'dashboard_version';
+               UPDATE transactions SET version = (SELECT value FROM app_state WHERE key = 'dashboard_version')
+               WHERE id = NEW.id;
+           END''',
+    ]),
+    ('deduplicate forwarded transactions by message id', [
+        # Set by the forwarder when it queues an SMS and kept across its
+        # retries, so a resent message is recognised and stored only once
+        'ALTER TABLE transactions ADD COLUMN message_id TEXT',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_message
+           ON transactions (message_id) WHERE message_id IS NOT NULL''',
+    ]),
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Apply every migration newer than the database's schema version.
+
+    Returns the resulting schema version.
+    """
+    target = len(migrations)
+    while schema_version(conn) < target:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have migrated while we waited for the lock
+            version = schema_version(conn)
+            if version >= target:
+                conn.rollback()
+                break
+            description, statements = migrations[version]
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    conn.execute('PRAGMA optimize')
+    return schema_version(conn)
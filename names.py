@@ -0,0 +1,325 @@
+"""Fuzzy matching of payer names against customer names.
+
+M-Pesa reports the payer's registered name ("JOHN KAMAU NJOROGE") while
+customers type whatever they like into the order form ("john kamau",
+"Jon Kamau").  Names are compared token by token: identical tokens score
+1, tokens with the same Soundex key 0.9 and anything else the Dice
+coefficient of their trigrams.  The shorter name's tokens are each matched
+to their best counterpart in the longer one and the scores averaged, so a
+customer who typed two of their three names still matches.
+
+``NameIndex`` keeps trigram and phonetic posting lists over the distinct
+tokens of the indexed names, so a search only scores names that share a
+similar token with the query instead of every pending order.
+
+A name match is weaker evidence than a reference: "JOHN OTIENO" scores
+0.8 against an order for "john" and "MARY WANJIRU" 0.81 against "mary
+wanjiku".  ``confident_match`` only picks a name that clears a stricter
+threshold, which a single matching token never does, and is clearly
+ahead of the next best; anything less is left for the cashier.
+"""
+import math
+import re
+from collections import defaultdict
+
+# Minimum score for a name to count as a match
+MATCH_THRESHOLD = 0.8
+# A single-token name ("John") is weak evidence on its own
+SINGLE_TOKEN_WEIGHT = 0.8
+# Minimum score for paying an order on its name alone.  Above
+# SINGLE_TOKEN_WEIGHT, so one matching token is never enough, and above
+# (1 + PHONETIC_SCORE) / 2, so of two tokens both must be spelt the same:
+# 'waku' and 'waji' sound alike but are different people
+CLAIM_THRESHOLD = 0.96
+# ... and how far it must be ahead of the next best name
+CLAIM_MARGIN = 0.1
+PHONETIC_SCORE = 0.9
+# Trigram similarity below which a Soundex match does not count ('jon'/'john' is 0.44)
+PHONETIC_MIN_SIMILARITY = 0.3
+# Token pairs scoring below this do not count towards a name's score
+MIN_TOKEN_SCORE = 0.5
+
+_NON_LETTERS = re.compile(r"[^a-z]+")
+_SOUNDEX_CODES = {}
+for _letters, _code in (('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'),
+                        ('l', '4'), ('mn', '5'), ('r', '6')):
+    for _letter in _letters:
+        _SOUNDEX_CODES[_letter] = _code
+
+
+def name_tokens(name):
+    """Lower-case words of a name with punctuation and digits removed"""
+    return [token for token in _NON_LETTERS.split((name or '').lower()) if token]
+
+
+def soundex(token):
+    """American Soundex code of a lower-case token, e.g. 'kamau' -> 'k500'"""
+    code = token[0]
+    previous = _SOUNDEX_CODES.get(token[0])
+    for letter in token[1:]:
+        digit = _SOUNDEX_CODES.get(letter)
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if letter not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+
+def trigrams(token):
+    padded = f"  {token} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class _Token:
+    __slots__ = ('text', 'phonetic', 'grams', 'indexed_grams')
+
+    def __init__(self, text):
+        self.text = text
+        self.phonetic = soundex(text)
+        self.grams = trigrams(text)
+        # '  k' only says the token starts with k and is shared with a large
+        # part of the vocabulary, so it is left out of the posting lists
+        self.indexed_grams = self.grams - {f"  {text[0]}"}
+
+
+def _analyze(name):
+    return [_Token(token) for token in name_tokens(name)]
+
+
+def _token_similarity(a, b):
+    if a.text == b.text:
+        return 1.0
+    similarity = 2 * len(a.grams & b.grams) / (len(a.grams) + len(b.grams))
+    # Soundex ignores vowels, so on its own it pairs 'jane' with 'john'
+    if a.phonetic == b.phonetic and similarity >= PHONETIC_MIN_SIMILARITY:
+        return max(similarity, PHONETIC_SCORE)
+    return similarity if similarity >= MIN_TOKEN_SCORE else 0.0
+
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    shorter, longer = (a, b) if len(a) <= len(b) else (b, a)
+    score = sum(max(_token_similarity(token, other) for other in longer)
+                for token in shorter) / len(shorter)
+    if len(shorter) == 1:
+        score *= SINGLE_TOKEN_WEIGHT
+    return score
+
+
+def name_similarity(a, b):
+    """Score between 0 and 1 for how likely two names belong to the same person"""
+    return _similarity(_analyze(a), _analyze(b))
+
+
+def confident_match(results):
+    """The key of the best of search() results if it is good enough to act on, else None"""
+    if not results:
+        return None
+    score, key = results[0]
+    if score < CLAIM_THRESHOLD:
+        return None
+    if len(results) > 1 and round(score - results[1][0], 9) < CLAIM_MARGIN:
+        return None
+    return key
+
+
+def _in_two(sets):
+    """Items found in at least two of sets"""
+    seen = set()
+    repeated = set()
+    for items in sets:
+        repeated |= seen & items
+        seen |= items
+    return repeated
+
+
+def _clear_bit(masks, value, bit_number):
+    mask = masks[value] & ~(1 << bit_number)
+    if mask:
+        masks[value] = mask
+    else:
+        del masks[value]
+
+
+def _discard(index, value, item):
+    items = index.get(value)
+    if items is not None:
+        items.discard(item)
+        if not items:
+            del index[value]
+
+
+class NameIndex:
+    """Names indexed by key for fuzzy search.
+
+    Matching works on the vocabulary of distinct tokens rather than on
+    every name: a query token is compared only with vocabulary tokens that
+    sound alike or share trigrams with it, and the names containing those
+    tokens are found through per-token posting lists.
+
+    Each vocabulary token has a small integer id, and the trigram posting
+    lists are bitmasks over those ids, so finding the tokens that share
+    enough trigrams with a query token is a few big-integer operations per
+    trigram rather than a count per token.  Similarity is symmetric, so
+    the similar tokens of every vocabulary token are kept up to date as
+    tokens come and go, and only query tokens that no indexed name
+    contains are looked up at search time.
+    """
+
+    def __init__(self):
+        # key -> token texts of its name
+        self._names = {}
+        self._keys_by_token = defaultdict(set)
+        # Keys whose name has a single distinct token
+        self._single_token_keys = set()
+        # Vocabulary: token text -> _Token, and its posting lists
+        self._vocabulary = {}
+        self._vocabulary_by_phonetic = defaultdict(set)
+        # Vocabulary token ids: text -> id, id -> text (None once freed)
+        self._token_ids = {}
+        self._token_texts = []
+        self._free_ids = []
+        # gram -> bitmask of the ids of the vocabulary tokens containing it
+        self._gram_masks = {}
+        # number of trigrams -> bitmask of the ids of the tokens with that many
+        self._size_masks = {}
+        # Vocabulary token text -> {text: similarity} of the vocabulary
+        # tokens resembling it, itself included
+        self._neighbors = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, key):
+        return key in self._names
+
+    def add(self, key, name):
+        self.remove(key)
+        texts = name_tokens(name)
+        self._names[key] = texts
+        if len(set(texts)) == 1:
+            self._single_token_keys.add(key)
+        for text in texts:
+            self._keys_by_token[text].add(key)
+            if text not in self._vocabulary:
+                token = self._vocabulary[text] = _Token(text)
+                self._vocabulary_by_phonetic[token.phonetic].add(text)
+                if self._free_ids:
+                    token_id = self._free_ids.pop()
+                    self._token_texts[token_id] = text
+                else:
+                    token_id = len(self._token_texts)
+                    self._token_texts.append(text)
+                self._token_ids[text] = token_id
+                bit = 1 << token_id
+                for gram in token.indexed_grams:
+                    self._gram_masks[gram] = self._gram_masks.get(gram, 0) | bit
+                size = len(token.grams)
+                self._size_masks[size] = self._size_masks.get(size, 0) | bit
+                neighbors = self._neighbors[text] = self._similar_tokens(token)
+                for other, similarity in neighbors.items():
+                    self._neighbors[other][text] = similarity
+
+    def remove(self, key):
+        self._single_token_keys.discard(key)
+        for text in self._names.pop(key, ()):
+            _discard(self._keys_by_token, text, key)
+            if text not in self._keys_by_token and text in self._vocabulary:
+                token = self._vocabulary.pop(text)
+                _discard(self._vocabulary_by_phonetic, token.phonetic, text)
+                for other in self._neighbors.pop(text):
+                    if other != text:
+                        del self._neighbors[other][text]
+                token_id = self._token_ids.pop(text)
+                self._token_texts[token_id] = None
+                self._free_ids.append(token_id)
+                _clear_bit(self._size_masks, len(token.grams), token_id)
+                for gram in token.indexed_grams:
+                    _clear_bit(self._gram_masks, gram, token_id)
+
+    def _similar_tokens(self, token):
+        """Return {text: similarity} for vocabulary tokens resembling token"""
+        size = len(token.grams)
+        # 2 * shared / (size + other_size) >= MIN_TOKEN_SCORE needs this
+        # many indexed trigrams in common with a token of other_size
+        # trigrams, even if both also start with the same letter
+        min_counts = {other_size: max(1, math.ceil(MIN_TOKEN_SCORE * (size + other_size) / 2 - 1))
+                      for other_size in self._size_masks}
+        levels = max(min_counts.values(), default=1)
+        # at_least[i]: tokens sharing more than i of the query's indexed trigrams
+        at_least = [0] * levels
+        for gram in token.indexed_grams:
+            mask = self._gram_masks.get(gram)
+            if mask:
+                for i in range(levels - 1, 0, -1):
+                    at_least[i] |= at_least[i - 1] & mask
+                at_least[0] |= mask
+        candidates = 0
+        for other_size, sized in self._size_masks.items():
+            if min_counts[other_size] <= levels:
+                candidates |= at_least[min_counts[other_size] - 1] & sized
+
+        vocabulary = self._vocabulary
+        texts = self._token_texts
+        grams = token.grams
+        similar = {}
+        while candidates:
+            bit = candidates & -candidates
+            candidates ^= bit
+            other = vocabulary[texts[bit.bit_length() - 1]]
+            similarity = 2 * len(grams & other.grams) / (size + len(other.grams))
+            if similarity >= MIN_TOKEN_SCORE:
+                similar[other.text] = similarity
+        similar.pop(token.text, None)
+        if token.text in vocabulary:
+            similar[token.text] = 1.0
+        # Tokens that sound alike; those not found above share too few
+        # trigrams to score on their own, so they only count through Soundex
+        for text in self._vocabulary_by_phonetic.get(token.phonetic, ()):
+            if text not in similar:
+                other = vocabulary[text]
+                if 2 * len(grams & other.grams) / (size + len(other.grams)) >= PHONETIC_MIN_SIMILARITY:
+                    similar[text] = PHONETIC_SCORE
+            elif similar[text] < PHONETIC_SCORE:
+                similar[text] = PHONETIC_SCORE
+        return similar
+
+    def search(self, name, threshold=MATCH_THRESHOLD):
+        """Return [(score, key)] for names scoring at least threshold, best first"""
+        query = _analyze(name)
+        if not query:
+            return []
+
+        # text -> similarity of the vocabulary tokens resembling each query token
+        similar = [self._neighbors.get(token.text) or self._similar_tokens(token) for token in query]
+        keys_at = [set().union(*(self._keys_by_token[text] for text in texts)) for texts in similar]
+
+        # A token contributes at most 1 to the average over the shorter name,
+        # so when both names have several tokens at least two query tokens
+        # (or two of the name's tokens) must have found a match
+        if len(query) == 1 or threshold <= 0.5:
+            candidates = set().union(*keys_at)
+        else:
+            candidates = _in_two(keys_at)
+            candidates |= _in_two(self._keys_by_token[text] for text in set().union(*similar))
+            for keys in keys_at:
+                candidates |= keys & self._single_token_keys
+
+        results = []
+        for key in candidates:
+            texts = self._names[key]
+            # Average over the shorter name, as in name_similarity()
+            if len(texts) < len(query):
+                best = [max(sims.get(text, 0.0) for sims in similar) for text in texts]
+            else:
+                best = [max(sims.get(text, 0.0) for text in texts) for sims in similar]
+            score = sum(best) / len(best)
+            if len(best) == 1:
+                score *= SINGLE_TOKEN_WEIGHT
+            if score >= threshold:
+                results.append((score, key))
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results
@@ -0,0 +1,81 @@
+"""Order lines.
+
+Each order's items live in ``order_items`` as (order_id, item_id, name,
+quantity, unit_price) rows.  The name and price are copied from the menu
+when the order is placed, so renaming or repricing a menu item later does
+not change what an existing order says was bought.
+"""
+from db import chunks
+from metrics import timed_query
+
+# Largest quantity of one item accepted from the order form
+MAX_QUANTITY = 50
+
+ORDER_ITEM_FIELDS = ('item_id', 'name', 'quantity', 'unit_price')
+
+
+def parse_order_form(form, menu):
+    """Read the ordered items from the order form.
+
+    Every selected menu item id is sent as ``items``; its quantity comes
+    from ``qty_<id>`` or, for older forms, from how often the id repeats.
+    Returns (lines, total) where lines are dicts with ORDER_ITEM_FIELDS.
+    """
+    quantities = {}
+    for value in form.getlist('items'):
+        try:
+            item_id = int(value)
+        except ValueError:
+            continue
+        quantities[item_id] = quantities.get(item_id, 0) + 1
+
+    lines = []
+    total = 0
+    for item_id, count in quantities.items():
+        item = menu.by_id.get(item_id)
+        if item is None:
+            continue
+        quantity = form.get(f'qty_{item_id}', count, type=int)
+        if quantity is None or quantity < 1:
+            continue
+        quantity = min(quantity, MAX_QUANTITY)
+        lines.append({
+            'item_id': item_id,
+            'name': item['name'],
+            'quantity': quantity,
+            'unit_price': item['price']
+        })
+        total += quantity * item['price']
+    return lines, total
+
+
+def save_order_items(c, order_id, lines):
+    with timed_query('order_items.insert') as query:
+        c.executemany('''INSERT INTO order_items (order_id, item_id, name, quantity, unit_price)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      [(order_id, line['item_id'], line['name'], line['quantity'], line['unit_price'])
+                       for line in lines])
+        query.rows = len(lines)
+
+
+def load_order_items(c, order_ids):
+    """Return {order_id: [line, ...]} for the given orders"""
+    items = {order_id: [] for order_id in order_ids}
+    order_ids = list(items)
+    with timed_query('order_items.load') as query:
+        for chunk in chunks(order_ids):
+            c.execute(f'''SELECT order_id, {', '.join(ORDER_ITEM_FIELDS)} FROM order_items
+                          WHERE order_id IN ({', '.join(['?'] * len(chunk))}) ORDER BY order_id, id''',
+                      chunk)
+            rows = c.fetchall()
+            query.rows += len(rows)
+            for row in rows:
+                items[row[0]].append(dict(zip(ORDER_ITEM_FIELDS, row[1:])))
+    return items
+
+
+def item_label(line):
+    """'rice' or '2 x rice', for templates and notifications"""
+    if line['quantity'] == 1:
+        return line['name']
+    return f"{line['quantity']} x {line['name']}"
@@ -0,0 +1,52 @@
+"""Pre-rendered, pre-compressed pages.
+
+A ``CachedPage`` holds a rendered page together with its gzip (and, when
+the optional ``brotli`` package is installed, brotli) encodings, an ETag
+and a Last-Modified time.  Serving it is a dictionary lookup; clients that
+already have the page get a 304 with no body.
+"""
+import gzip
+import hashlib
+from datetime import datetime, timezone
+
+from flask import request, make_response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CachedPage:
+    def __init__(self, body, mimetype='text/html'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        # Content-Encoding -> body, best compression first
+        self.encodings = {}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(body, quality=11)
+        self.encodings['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+        self.encodings['identity'] = body
+
+    def make_response(self):
+        """Build a response for the current request, honouring Accept-Encoding and conditional headers"""
+        encoding = 'identity'
+        for candidate in self.encodings:
+            if candidate != 'identity' and candidate in request.accept_encodings:
+                encoding = candidate
+                break
+
+        response = make_response(self.encodings[encoding])
+        response.mimetype = self.mimetype
+        if encoding != 'identity':
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        # Each encoding is a different byte stream, so it needs its own tag
+        response.set_etag(self.etag if encoding == 'identity' else f"{self.etag}-{encoding}")
+        response.last_modified = self.last_modified
+        # Always revalidate: a changed menu must show up straight away
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
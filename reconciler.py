@@ -0,0 +1,103 @@
+"""Background reconciliation.
+
+A ``ReconciliationWorker`` thread runs a task (matching new payments to
+orders) on its own schedule instead of whenever an admin page happens to
+poll.  The interval grows while there is nothing to do and snaps back as
+soon as there is, every wait is jittered so workers started together
+drift apart, and a full batch is followed straight away by the next one.
+
+Several gunicorn workers may each start a worker; a lease row in the
+``worker_leases`` table makes sure only one of them runs the task at a
+time.  The lease expires if its holder dies, so another takes over.
+"""
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+
+def acquire_lease(conn, name, owner, ttl):
+    """Take or renew the named lease for ttl seconds; True if owner holds it"""
+    now = time.time()
+    c = conn.cursor()
+    c.execute('''INSERT INTO worker_leases (name, owner, expires_at) VALUES (?, ?, ?)
+                 ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                 WHERE worker_leases.owner = excluded.owner OR worker_leases.expires_at < ?''',
+              (name, owner, now + ttl, now))
+    conn.commit()
+    return c.rowcount == 1
+
+
+def release_lease(conn, name, owner):
+    conn.execute('DELETE FROM worker_leases WHERE name = ? AND owner = ?', (name, owner))
+    conn.commit()
+
+
+class ReconciliationWorker(threading.Thread):
+    """Runs task() in the background while holding a leader lease.
+
+    task() is called inside an app context and returns how many items it
+    processed; when that equals batch_size it is called again immediately.
+    """
+
+    def __init__(self, app, task, name='reconciler', batch_size=500,
+                 min_interval=1, max_interval=30, jitter=0.2, lease_ttl=None):
+        super().__init__(daemon=True, name=name)
+        self.app = app
+        self.task = task
+        self.lease_name = name
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        # Long enough to survive the slowest sleep between renewals
+        self.lease_ttl = lease_ttl or max_interval * 3
+        self.owner = uuid.uuid4().hex
+        self.interval = min_interval
+        self.is_leader = False
+        self._stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        """Ask the worker to finish its current batch and exit, then wait for it"""
+        self._stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def _wait(self, seconds):
+        seconds *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self._stopping.wait(seconds)
+
+    def run(self):
+        pool = self.app.extensions['db_pool']
+        while not self._stopping.is_set():
+            try:
+                with pool.connection() as conn:
+                    self.is_leader = acquire_lease(conn, self.lease_name, self.owner, self.lease_ttl)
+                if not self.is_leader:
+                    # Check back before the current leader's lease could run out
+                    self._wait(self.max_interval)
+                    continue
+
+                with self.app.app_context():
+                    processed = self.task()
+            except Exception:
+                self.app.logger.exception('Reconciliation pass failed')
+                self.interval = self.max_interval
+                self._wait(self.interval)
+                continue
+
+            if processed >= self.batch_size:
+                continue  # More work is waiting
+            if processed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.max_interval, self.interval * 2)
+            self._wait(self.interval)
+
+        if self.is_leader:
+            try:
+                with pool.connection() as conn:
+                    release_lease(conn, self.lease_name, self.owner)
+            except sqlite3.Error:
+                pass  # It expires on its own
@@ -0,0 +1,89 @@
+"""Order references.
+
+A reference is ``ORD`` followed by a number in Crockford base32 (digits and
+upper-case letters without I, L, O and U, so it is hard to mistype) and a
+Luhn mod 32 check character, e.g. ``ORD0042Q``.  The check character
+catches every single-character typo and most swapped neighbours before a
+payment is matched against the wrong order.
+
+Numbers come from the ``reference_next`` counter in ``app_state``.  Each
+process reserves a block of numbers in one short write transaction and
+then hands them out from memory, so references are unique across threads
+and worker processes without a database round trip per order.  Numbers
+left in a block when a process exits are simply never used.
+"""
+import threading
+
+PREFIX = 'ORD'
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+# Pad numbers to this many characters: 32**4 (about a million) orders fit
+# in an 8-character reference, after that references grow by one character
+MIN_DIGITS = 4
+
+_VALUES = {char: value for value, char in enumerate(ALPHABET)}
+
+
+def check_character(digits):
+    """Luhn mod 32 check character for a string of ALPHABET characters"""
+    total = 0
+    factor = 2
+    for char in reversed(digits):
+        addend = factor * _VALUES[char]
+        total += addend // len(ALPHABET) + addend % len(ALPHABET)
+        factor = 1 if factor == 2 else 2
+    return ALPHABET[-total % len(ALPHABET)]
+
+
+def format_reference(number):
+    digits = ''
+    while number:
+        number, remainder = divmod(number, len(ALPHABET))
+        digits = ALPHABET[remainder] + digits
+    digits = digits.rjust(MIN_DIGITS, ALPHABET[0])
+    return PREFIX + digits + check_character(digits)
+
+
+def is_valid_reference(reference):
+    """True if reference is well formed and its check character matches"""
+    reference = (reference or '').strip().upper()
+    if not reference.startswith(PREFIX) or len(reference) < len(PREFIX) + MIN_DIGITS + 1:
+        return False
+    digits, check = reference[len(PREFIX):-1], reference[-1]
+    if any(char not in _VALUES for char in digits):
+        return False
+    return check_character(digits) == check
+
+
+def reserve_block(conn, size):
+    """Reserve size reference numbers and return the first one"""
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute("SELECT value FROM app_state WHERE key = 'reference_next'")
+        start = c.fetchone()[0]
+        c.execute("UPDATE app_state SET value = ? WHERE key = 'reference_next'", (start + size,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return start
+
+
+class ReferenceAllocator:
+    """Hands out unique order references from blocks reserved in the database"""
+
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def allocate(self, conn):
+        """Return a new reference; conn is only used when a new block is needed"""
+        with self._lock:
+            if self._next >= self._end:
+                self._next = reserve_block(conn, self.block_size)
+                self._end = self._next + self.block_size
+            number = self._next
+            self._next += 1
+        return format_reference(number)
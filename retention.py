@@ -0,0 +1,159 @@
+"""Expiry and archival of old rows.
+
+Pending orders nobody paid for within ``ttl`` seconds are marked
+``expired``.  Paid and expired orders and examined transactions older than
+the archive age are moved out of the hot tables into one SQLite file per
+month (``orders-YYYY-MM.db`` in the archive directory), so the tables the
+dashboard and matcher read only hold recent activity.
+
+SQLite does not commit a transaction atomically across attached files
+when one of them is in WAL mode, so each month is moved in two
+transactions that each write one file: the rows are copied into the
+archive and committed, then the rows whose archived copy matches are
+deleted from the main database.  After a crash between the two a row is
+in both places until the next run copies and deletes it again, but never
+in neither.  A row that changed in between (an expired order paid late)
+stays in the main database and is copied afresh next time.
+"""
+import os
+
+from matcher import HIGH_WATER_MARK_KEY
+from metrics import timed_query
+
+ARCHIVE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS archive.orders
+       (id INTEGER PRIMARY KEY,
+        customer_name TEXT,
+        items TEXT,
+        total_amount INTEGER,
+        status TEXT,
+        reference TEXT,
+        created_at TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS archive.transactions
+       (id INTEGER PRIMARY KEY,
+        sender_name TEXT,
+        amount INTEGER,
+        reference TEXT,
+        order_id INTEGER,
+        sms_text TEXT,
+        received_at TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS archive.order_items
+       (id INTEGER PRIMARY KEY,
+        order_id INTEGER NOT NULL,
+        item_id INTEGER,
+        name TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit_price INTEGER NOT NULL)''',
+]
+ORDER_COLUMNS = 'id, customer_name, items, total_amount, status, reference, created_at'
+TRANSACTION_COLUMNS = 'id, sender_name, amount, reference, order_id, sms_text, received_at'
+ORDER_ITEM_COLUMNS = 'id, order_id, item_id, name, quantity, unit_price'
+
+
+def expire_pending_orders(conn, ttl, limit=500):
+    """Mark up to limit pending orders older than ttl seconds as expired; returns their ids"""
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        with timed_query('retention.expire_orders') as query:
+            c.execute('''SELECT id FROM orders
+                         WHERE status = 'pending' AND created_at < datetime('now', ?)
+                         ORDER BY created_at LIMIT ?''', (f'-{int(ttl)} seconds', limit))
+            order_ids = [row[0] for row in c.fetchall()]
+            c.executemany('''UPDATE orders SET status = 'expired' WHERE id = ? AND status = 'pending' ''',
+                          [(order_id,) for order_id in order_ids])
+            query.rows = len(order_ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return order_ids
+
+
+def archive_path(archive_dir, month):
+    return os.path.join(archive_dir, f'orders-{month}.db')
+
+
+def _months_to_archive(c, cutoff, last_transaction_id):
+    c.execute('''SELECT DISTINCT strftime('%Y-%m', created_at) FROM orders
+                 WHERE status IN ('paid', 'expired') AND created_at < datetime('now', ?)''', (cutoff,))
+    months = {row[0] for row in c.fetchall()}
+    c.execute('''SELECT DISTINCT strftime('%Y-%m', received_at) FROM transactions
+                 WHERE received_at < datetime('now', ?) AND id <= ?''', (cutoff, last_transaction_id))
+    months.update(row[0] for row in c.fetchall())
+    return sorted(months)
+
+
+def archive_old_rows(conn, archive_dir, days):
+    """Move finished orders and examined transactions older than days into monthly files.
+
+    Returns the number of rows moved.
+    """
+    cutoff = f'-{int(days)} days'
+    c = conn.cursor()
+    # Transactions the matcher has not examined yet stay where it can see them
+    c.execute('SELECT value FROM matcher_state WHERE key = ?', (HIGH_WATER_MARK_KEY,))
+    row = c.fetchone()
+    last_transaction_id = row[0] if row else 0
+
+    moved = 0
+    os.makedirs(archive_dir, exist_ok=True)
+    for month in _months_to_archive(c, cutoff, last_transaction_id):
+        month_start = f'{month}-01'
+        order_filter = '''status IN ('paid', 'expired') AND created_at < datetime('now', ?)
+                          AND created_at >= ? AND created_at < date(?, '+1 month')'''
+        transaction_filter = '''received_at < datetime('now', ?) AND id <= ?
+                                AND received_at >= ? AND received_at < date(?, '+1 month')'''
+        order_args = (cutoff, month_start, month_start)
+        transaction_args = (cutoff, last_transaction_id, month_start, month_start)
+
+        # ATTACH cannot run inside a transaction
+        c.execute('ATTACH DATABASE ? AS archive', (archive_path(archive_dir, month),))
+        try:
+            for statement in ARCHIVE_SCHEMA:
+                c.execute(statement)
+            with timed_query('retention.archive_month') as query:
+                # Copy, committing to the archive file only.  A copy left by
+                # an earlier, interrupted run is replaced with the current row.
+                c.execute('BEGIN IMMEDIATE')
+                try:
+                    c.execute(f'''INSERT OR REPLACE INTO archive.orders ({ORDER_COLUMNS})
+                                  SELECT {ORDER_COLUMNS} FROM main.orders WHERE {order_filter}''', order_args)
+                    c.execute(f'''INSERT OR REPLACE INTO archive.order_items ({ORDER_ITEM_COLUMNS})
+                                  SELECT {ORDER_ITEM_COLUMNS} FROM main.order_items
+                                  WHERE order_id IN (SELECT id FROM main.orders WHERE {order_filter})''',
+                              order_args)
+                    c.execute(f'''INSERT OR REPLACE INTO archive.transactions ({TRANSACTION_COLUMNS})
+                                  SELECT {TRANSACTION_COLUMNS} FROM main.transactions
+                                  WHERE {transaction_filter}''', transaction_args)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+
+                # Delete, committing to the main database only, and only rows
+                # whose archived copy is still what the main database holds
+                archived_order = f'''{order_filter} AND EXISTS (
+                    SELECT 1 FROM archive.orders a WHERE a.id = main.orders.id
+                    AND a.status IS main.orders.status)'''
+                c.execute('BEGIN IMMEDIATE')
+                try:
+                    c.execute(f'''DELETE FROM main.order_items
+                                  WHERE id IN (SELECT id FROM archive.order_items)
+                                  AND order_id IN (SELECT id FROM main.orders WHERE {archived_order})''',
+                              order_args)
+                    c.execute(f'DELETE FROM main.orders WHERE {archived_order}', order_args)
+                    query.rows += c.rowcount
+                    c.execute(f'''DELETE FROM main.transactions WHERE {transaction_filter} AND EXISTS (
+                                      SELECT 1 FROM archive.transactions a WHERE a.id = main.transactions.id
+                                      AND a.order_id IS main.transactions.order_id)''',
+                              transaction_args)
+                    query.rows += c.rowcount
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            moved += query.rows
+        finally:
+            c.execute('DETACH DATABASE archive')
+    return moved
@@ -0,0 +1,59 @@
+"""Sales statistics from the rollup tables.
+
+``sales_hourly``, ``sales_daily`` and ``item_sales_daily`` are kept up to
+date by triggers on ``orders`` and ``order_items`` (see migrations 8 and 9), whichever code path
+creates, pays or expires an order.  Reading them costs a few rows per day
+asked for, however many orders there are, and archiving old orders does
+not change them.  Days and hours are in UTC, like ``created_at``.
+"""
+from datetime import datetime, timedelta, timezone
+
+from metrics import timed_query
+
+SALES_FIELDS = ('orders_created', 'orders_paid', 'orders_expired', 'revenue_ordered', 'revenue_paid')
+ITEM_SALES_FIELDS = ('item', 'ordered', 'paid', 'revenue_ordered', 'revenue_paid')
+
+
+def _conversion_rate(totals):
+    if not totals['orders_created']:
+        return None
+    return round(totals['orders_paid'] / totals['orders_created'], 4)
+
+
+def sales_summary(conn, days=7, top_items=10):
+    """Totals for today and the last days days, hourly figures for today and the best-selling items"""
+    now = datetime.now(timezone.utc)
+    today = now.strftime('%Y-%m-%d')
+    first_day = (now - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    c = conn.cursor()
+
+    with timed_query('stats.sales_summary') as query:
+        c.execute(f'''SELECT day, {', '.join(SALES_FIELDS)} FROM sales_daily
+                      WHERE day >= ? ORDER BY day''', (first_day,))
+        daily = [dict(zip(('day',) + SALES_FIELDS, row)) for row in c.fetchall()]
+
+        c.execute(f'''SELECT hour, {', '.join(SALES_FIELDS)} FROM sales_hourly
+                      WHERE hour >= ? ORDER BY hour''', (today,))
+        hourly = [dict(zip(('hour',) + SALES_FIELDS, row)) for row in c.fetchall()]
+
+        c.execute('''SELECT item, SUM(ordered), SUM(paid), SUM(revenue_ordered), SUM(revenue_paid)
+                     FROM item_sales_daily WHERE day >= ?
+                     GROUP BY item ORDER BY SUM(paid) DESC, SUM(ordered) DESC, item
+                     LIMIT ?''', (first_day, top_items))
+        items = [dict(zip(ITEM_SALES_FIELDS, row)) for row in c.fetchall()]
+        query.rows = len(daily) + len(hourly) + len(items)
+
+    totals = {field: sum(day[field] for day in daily) for field in SALES_FIELDS}
+    totals['conversion_rate'] = _conversion_rate(totals)
+    today_totals = next((dict(day) for day in daily if day['day'] == today),
+                        dict({field: 0 for field in SALES_FIELDS}, day=today))
+    today_totals['conversion_rate'] = _conversion_rate(today_totals)
+
+    return {
+        'days': days,
+        'today': today_totals,
+        'totals': totals,
+        'daily': daily,
+        'hourly': hourly,
+        'top_items': items
+    }
@@ -0,0 +1,9 @@
+"""WSGI entry point for production servers, e.g. ``gunicorn -c gunicorn.conf.py``.
+
+The schema is migrated once when this module is imported; each worker
+process starts its own background threads with the first request it
+handles (see ``app.create_app``).
+"""
+from app import create_app
+
+application = create_app(start_workers=False)